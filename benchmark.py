@@ -0,0 +1,273 @@
+"""
+北極探検ゲームのベンチマーク
+各ステージ（と敵を増やした合成ステージ）を決まった tick 数だけ動かし、
+プレイヤーの更新・敵の更新・当たり判定・描画のそれぞれについて秒あたりの tick 数を測る
+--sprites では N 個のスプライトを1つずつ draw する場合と RenderQueue でまとめて描く場合を比べる
+結果は JSON で保存し、--compare で前回の結果と比べて遅くなった項目を報告する
+
+    python benchmark.py --ticks 600 --scales 1,10,100 --output bench.json
+    python benchmark.py --sprites 10,100,1000
+    python benchmark.py --compare bench.json
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # 画面を開かずに描画する
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import pygame as pg
+
+import north_adventure as na
+
+
+def scale_stage(world, scale, rng):
+    """ステージの敵と落ちてくる敵を scale 倍に増やす（合成ステージ）"""
+    if scale <= 1:
+        return
+    enemies = list(world.enemies)
+    falling = list(world.falling_enemies)
+    for i in range(1, scale):
+        for e in world.enemies:
+            x = (e.rect.x + i * 37) % (na.WIDTH - e.rect.width)
+            enemies.append(na.Enemy(x, e.rect.bottom, rng=rng))
+        for fe in world.falling_enemies:
+            falling.append(na.FallingEnemy((fe.rect.x + i * 53) % na.WIDTH,
+                                           fe.rect.y - rng.randint(0, na.HEIGHT), speed=fe.vy))
+        # 敵のいないステージでも負荷がかかるよう、地面の上に1体ずつ置く
+        if not world.enemies and world.ground_platforms:
+            g = world.ground_platforms[i % len(world.ground_platforms)]
+            enemies.append(na.Enemy(g.x + (i * 37) % max(1, g.width - 60), g.top, rng=rng))
+    world.enemies = enemies
+    world.falling_enemies = falling
+
+
+def new_world(stage_index, scale, seed=0):
+    """stage_index のステージをプレイ中の状態で用意する"""
+    world = na.World(seed=seed)
+    world.stage_index_count = 0
+    world.load_stage(stage_index, seed)
+    world.state = "play"
+    scale_stage(world, scale, random.Random(seed))
+    # 敵に当たって終わらないように無敵にしておく
+    world.player.apply_power('muteki', duration=1e9)
+    return world
+
+
+def scripted_input(i):
+    """右に進みながら時々ジャンプする入力"""
+    return na.InputState(right=(i % 90) < 70, left=(i % 90) >= 80, jump=(i % 25) == 0)
+
+
+def bench_player(world, ticks):
+    """Player.handle_input / update（_collide を含む）"""
+    player = world.player
+    start_pos = player.rect.topleft
+    elapsed = 0.0
+    for i in range(ticks):
+        player.handle_input(scripted_input(i))
+        t = time.perf_counter()
+        player.update(world.tiles, world.hatena_platforms, world.items)
+        elapsed += time.perf_counter() - t
+        if player.rect.top > na.HEIGHT or player.rect.right > na.WIDTH:
+            player.rect.topleft = start_pos
+            player.vy = 0
+    return elapsed
+
+
+def bench_enemies(world, ticks):
+    """Enemy.update と FallingEnemy.update"""
+    t = time.perf_counter()
+    for _ in range(ticks):
+        for e in world.enemies:
+            e.update(world.tiles)
+        for fe in world.falling_enemies:
+            fe.update()
+    return time.perf_counter() - t
+
+
+def bench_collisions(world, ticks, projectiles_per_tick):
+    """弾・プレイヤーと敵の当たり判定（World.collect_collisions）"""
+    rng = random.Random(1)
+    world.projectiles = [na.Projectile(rng.randint(0, na.WIDTH), rng.randint(0, na.HEIGHT), 'fire', 1)
+                         for _ in range(projectiles_per_tick)]
+    elapsed = 0.0
+    for _ in range(ticks):
+        for p in world.projectiles:
+            p.rect.x = (p.rect.x + 10) % na.WIDTH
+        t = time.perf_counter()
+        world.collect_collisions()
+        elapsed += time.perf_counter() - t
+    world.projectiles = []
+    return elapsed
+
+
+def bench_draw(world, ticks, screen, static_layer, power_display):
+    """draw_play による描画全体（画面への転送は含まない）"""
+    t = time.perf_counter()
+    for i in range(ticks):
+        na.draw_play(screen, world, static_layer, power_display, alpha=(i % 4) / 4)
+    return time.perf_counter() - t
+
+
+def make_sprites(count, rng):
+    """画面中に散らばった count 個のスプライト（敵・落ちてくる敵・アイテム・弾）を (レイヤー, obj) で作る"""
+    sprites = []
+    for i in range(count):
+        x = rng.randint(0, na.WIDTH - 60)
+        y = rng.randint(60, na.HEIGHT - 60)
+        kind = i % 4
+        if kind == 0:
+            sprites.append((na.LAYER_ENEMIES, na.Enemy(x, y, rng=rng)))
+        elif kind == 1:
+            sprites.append((na.LAYER_FALLING, na.FallingEnemy(x, y)))
+        elif kind == 2:
+            sprites.append((na.LAYER_ITEMS, na.Item(x, y, rng.choice(sorted(na.ITEM_IMAGES)))))
+        else:
+            sprites.append((na.LAYER_PROJECTILES, na.Projectile(x, y, rng.choice(('fire', 'ice')), 1)))
+    # 元の描画順（レイヤー順）で1つずつ描く経路と同じ並びにしておく
+    sprites.sort(key=lambda s: s[0])
+    return sprites
+
+
+def bench_sprites_objects(sprites, ticks, screen):
+    """1つずつ obj.draw で描く（これまでの経路）"""
+    t = time.perf_counter()
+    for i in range(ticks):
+        alpha = (i % 4) / 4
+        for _, obj in sprites:
+            obj.draw(screen, alpha)
+    return time.perf_counter() - t
+
+
+def bench_sprites_queue(sprites, ticks, screen):
+    """RenderQueue に集めてレイヤーごとに blits() で描く"""
+    queue = na.RenderQueue()
+    t = time.perf_counter()
+    for i in range(ticks):
+        alpha = (i % 4) / 4
+        for layer, obj in sprites:
+            queue.add_sprite(layer, obj, alpha)
+        queue.flush(screen)
+    return time.perf_counter() - t
+
+
+def run_sprites(ticks, counts):
+    """スプライトの数ごとに、1つずつ描く場合と RenderQueue の場合の描画速度を測る"""
+    pg.init()
+    screen = pg.display.set_mode((na.WIDTH, na.HEIGHT))
+    na.warm_sprite_assets()
+    results = []
+    for count in counts:
+        sprites = make_sprites(count, random.Random(count))
+        for phase, fn in (("draw_objects", bench_sprites_objects), ("draw_queue", bench_sprites_queue)):
+            seconds = fn(sprites, ticks, screen)
+            results.append({
+                "stage": "sprites", "scale": count, "phase": phase, "entities": count,
+                "ticks": ticks, "seconds": seconds,
+                "ticks_per_sec": ticks / seconds if seconds > 0 else None,
+            })
+            print(f"{'sprites':12s} x{count:<4d} {phase:12s} "
+                  f"{results[-1]['ticks_per_sec'] or 0:12.0f} ticks/s")
+    pg.quit()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(ticks, scales, stages, sprite_counts=()):
+    results = run_sprites(ticks, sprite_counts) if sprite_counts else []
+    pg.init()
+    screen = pg.display.set_mode((na.WIDTH, na.HEIGHT))
+    na.warm_sprite_assets()
+    power_display = na.PowerUpDisplay(pos=(na.WIDTH - 80, 20))
+    for stage_index in stages:
+        for scale in scales:
+            name = os.path.basename(na.STAGE_BUILDERS[stage_index].path)
+            phases = {
+                "player": lambda w: bench_player(w, ticks),
+                "enemies": lambda w: bench_enemies(w, ticks),
+                "collisions": lambda w: bench_collisions(w, ticks, 10 * scale),
+                "draw": lambda w: bench_draw(w, ticks, screen, na.StaticLayer(), power_display),
+            }
+            for phase, fn in phases.items():
+                world = new_world(stage_index, scale)
+                entities = len(world.enemies) + len(world.falling_enemies)
+                seconds = fn(world)
+                results.append({
+                    "stage": name, "scale": scale, "phase": phase, "entities": entities,
+                    "ticks": ticks, "seconds": seconds,
+                    "ticks_per_sec": ticks / seconds if seconds > 0 else None,
+                })
+                print(f"{name:12s} x{scale:<4d} {phase:10s} {entities:6d} entities "
+                      f"{results[-1]['ticks_per_sec'] or 0:12.0f} ticks/s")
+    pg.quit()
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "pygame": pg.version.ver,
+            "platform": platform.platform(),
+            "ticks": ticks,
+        },
+        "results": results,
+    }
+
+
+def compare(current, previous, threshold):
+    """前回より threshold 以上遅くなった項目を返す"""
+    key = lambda r: (r["stage"], r["scale"], r["phase"])
+    before = {key(r): r for r in previous["results"]}
+    regressions = []
+    for r in current["results"]:
+        old = before.get(key(r))
+        if not old or not old["ticks_per_sec"] or not r["ticks_per_sec"]:
+            continue
+        ratio = r["ticks_per_sec"] / old["ticks_per_sec"]
+        if ratio < 1 - threshold:
+            regressions.append((key(r), old["ticks_per_sec"], r["ticks_per_sec"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="北極探検ゲームのベンチマーク")
+    parser.add_argument("--ticks", type=int, default=600, help="各項目で進める tick 数")
+    parser.add_argument("--scales", default="1,10,100", help="敵の数の倍率（カンマ区切り）")
+    parser.add_argument("--stages", default=None, help="測るステージの添字（カンマ区切り、省略時は全て）")
+    parser.add_argument("--sprites", default=None,
+                        help="描画だけを比べるスプライトの数（カンマ区切り、例: 10,100,1000）")
+    parser.add_argument("--output", default=None, help="結果の JSON を保存するパス")
+    parser.add_argument("--compare", default=None, help="比べる前回の結果の JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="遅くなったとみなす割合")
+    args = parser.parse_args(argv)
+
+    scales = [int(v) for v in args.scales.split(",")]
+    stages = ([int(v) for v in args.stages.split(",")] if args.stages
+              else list(range(len(na.STAGE_BUILDERS))))
+    sprite_counts = [int(v) for v in args.sprites.split(",")] if args.sprites else []
+    report = run(args.ticks, scales, stages, sprite_counts)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = compare(report, previous, args.threshold)
+        for (stage, scale, phase), old, new, ratio in regressions:
+            print(f"REGRESSION {stage} x{scale} {phase}: {old:.0f} -> {new:.0f} ticks/s ({ratio:.0%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
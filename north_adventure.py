@@ -1,13 +1,35 @@
 import os
 import math
 import sys
+import time
+PROCESS_START = time.perf_counter()  # --measure-startup の基準（pygame の読み込みも含める）
 import pygame as pg
 import threading
 import random
+import struct
+import argparse
+import functools
+import hashlib
+import json
+import zlib
+from collections import deque, namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy がなければ HazardStore（敵のまとめて更新）は使えない
+    np = None
 
 WIDTH, HEIGHT = 900, 600
-FPS = 60
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
+FPS = 60  # 描画の目標フレームレート（--fps で変更できる）
+SIM_HZ = 60  # 物理演算の更新回数（秒あたり）。描画のフレームレートとは独立
+SIM_DT = 1 / SIM_HZ
+MAX_FRAME_TIME = 0.25  # 処理落ちしたときに追いかける最大の時間（秒）
+# メニュー画面（動くものがない）では描き終えたらキー入力を待って眠る
+MENU_STATES = ("start", "gameover", "goal")
+MENU_WAIT_MS = 1000  # 何も起きなくてもこの間隔で起きる
+LOADING_WAIT_MS = 50  # 読み込み中は進み具合のバーを進めるためにこの間隔で起きる
+# 画像やステージはこのファイルからの相対パスで探す（作業ディレクトリは変えない）
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 BG = (135, 206, 235)
 WHITE = (255, 255, 255)
@@ -22,9 +44,285 @@ Player_base_height = 50  # 基準となるキャラクターの高さ
 Enemy_base_height = 60  # 基準となるキャラクターの高さ
 FallingEnemy_base_height = 50  # 基準となるキャラクターの高さ
 
-# ... (Player クラスの定義はそのまま。画像ロードもそのまま利用) ...
+# 能力ごとのプレイヤー画像 (画像パス, 高さ)。None は通常状態
+PLAYER_IMAGES = {
+    None:     ("img/penguin_right.png", 70),
+    'fire':   ("img/power/penguin_honoo.png", 90),
+    'ice':    ("img/power/penguin_koori.png", 90),
+    'jump':   ("img/power/penguin_usagi.png", 90),
+    'speed':  ("img/power/penguin_speed.png", 50),
+    'muteki': ("img/power/penguin_muteki.png", 70),
+}
+# アイテムの種類ごとの画像パス
+ITEM_IMAGES = {
+    'fire': "img/item/honoo-item.png",
+    'ice': "img/item/koori-item.png",
+    'jump': "img/item/jamp-item.png",
+    'speed': "img/item/speedup-item.png",
+    'muteki': "img/item/muteki-item.png",
+}
+# 敵の画像パスと移動速度（シロクマは速く、カメは遅い）
+ENEMY_KINDS = {
+    "img/sirokuma.png": -3,
+    "img/kame.png": -1,
+}
+FALLING_ENEMY_IMAGE = "img/koura.png"
+PROJECTILE_IMAGES = {'fire': "img/fireball.png", 'ice': "img/iceball.png"}
+PROJECTILE_WIDTH = 50
+HATENA_IMAGE = "img/hatena.png"
+HATENA_EMPTY_IMAGE = "img/hatena_empty.png"
+GOAL_IMAGE = "img/goal_pole.png"
+BG_IMAGE = "img/haikei.png"
+GROUND_IMAGE = "img/ground.png"
+BLOCK_IMAGE = "img/huyuu.png"
+INVUL_TIME = 1.0  # 敵に当たって能力を失った後、敵に当たっても平気な時間（秒）
+ITEM_REVEAL_TIME = 0.25  # ハテナブロックを叩いてからアイテムが出てくるまでの時間（秒）
+FALLING_RESPAWN_TIME = 0.5  # 落ちてくる敵が画面の下に消えてから、また上から出てくるまでの時間（秒）
+STAGE_TIMER_EVENTS = ("reveal_item", "respawn_falling")  # ステージを切り替えたら取り消すタイマー
+TELEPORT_DISTANCE = 100  # これ以上動いたときは補間せずにそのまま描画する（ワープや画面外からの再出現）
+CULL_MARGIN = 100  # 画面の外でもこれより近いものは描く（rect からはみ出す画像の分）
+
+
+def interpolated_pos(obj, alpha, offset_x=0):
+    """
+    前のtickの位置 (obj.prev_pos) と現在の位置を alpha (0〜1) で補間した左上の座標を返す
+    offset_x: カメラの位置。スクロールするときは画面上の座標にずらして返す
+    毎フレーム呼ばれるので Rect は作らない。描画だけに使い、当たり判定には使わない
+    """
+    rect = obj.rect
+    x = rect.x
+    y = rect.y
+    prev = getattr(obj, "prev_pos", None)
+    if prev is not None and alpha < 1.0:
+        dx = x - prev[0]
+        dy = y - prev[1]
+        if abs(dx) <= TELEPORT_DISTANCE and abs(dy) <= TELEPORT_DISTANCE:
+            x = round(prev[0] + dx * alpha)
+            y = round(prev[1] + dy * alpha)
+    return x - offset_x, y
+
+
+def midbottom_pos(image, rect, x, y):
+    """rect を (x, y) に置いたとき、image の足元中央を rect の足元中央に合わせる左上の座標"""
+    w, h = image.get_size()
+    return x + rect.width // 2 - w // 2, y + rect.height - h
+
+
+class AssetCache:
+    """
+    画像を一度だけデコードし、拡大縮小・反転済みの Surface を共有するキャッシュ
+    キーは (パス, サイズ, 反転, alpha)。hits / misses で再利用の状況を確認できる
+    """
+    def __init__(self, base_dir=BASE_DIR):
+        self.base_dir = base_dir  # パスはここからの相対パス
+        self._loaded = {}    # パス -> ファイルから読んだだけの（convert していない）画像
+        self._decoded = {}   # (パス, alpha) -> 元画像
+        self._variants = {}  # (パス, サイズ, 反転, alpha) -> 加工済み画像
+        self._sizes = {}     # パス -> 元画像のサイズ
+        self._masks = {}     # (パス, サイズ, 反転) -> 当たり判定用のマスク
+        self.hits = 0
+        self.misses = 0
+        self.decodes = 0
+        self.scales = 0
+
+    def _load(self, path):
+        """ファイルを読むのはパスごとに1回だけ（画面がなくても使える）"""
+        img = self._loaded.get(path)
+        if img is None:
+            img = self._loaded[path] = pg.image.load(os.path.join(self.base_dir, path))
+        return img
+
+    def _decode(self, path, alpha=True):
+        img = self._decoded.get((path, alpha))
+        if img is None:
+            img = self._load(path)
+            img = img.convert_alpha() if alpha else img.convert()
+            self._decoded[(path, alpha)] = img
+            self.decodes += 1
+        return img
+
+    def native_size(self, path):
+        """
+        元画像のサイズ (幅, 高さ) を返す
+        PNG はヘッダだけを読むので、画面がなくてもデコードせずに使える
+        """
+        size = self._sizes.get(path)
+        if size is None:
+            with open(os.path.join(self.base_dir, path), "rb") as f:
+                head = f.read(24)
+            if head[:8] == b"\x89PNG\r\n\x1a\n":
+                size = struct.unpack(">II", head[16:24])
+            else:
+                size = self._decode(path).get_size()
+            self._sizes[path] = size
+        return size
+
+    def size_for_height(self, path, height):
+        """アスペクト比を維持して高さ height にしたときのサイズ"""
+        orig_w, orig_h = self.native_size(path)
+        return (int(height * orig_w / orig_h), height)
+
+    def size_for_width(self, path, width):
+        """アスペクト比を維持して幅 width にしたときのサイズ"""
+        orig_w, orig_h = self.native_size(path)
+        return (width, int(width * orig_h / orig_w))
+
+    def get(self, path, size=None, flip=False, alpha=True):
+        """
+        加工済みの画像を返す。返り値は共有されるので書き換えないこと
+        size: None なら元のサイズ, flip: True なら左右反転
+        alpha: False なら透明度を持たない形式（背景など）。True のものとは別に持つ
+        """
+        key = (path, size, flip, alpha)
+        img = self._variants.get(key)
+        if img is not None:
+            self.hits += 1
+            return img
+        self.misses += 1
+        if flip:
+            # 反転前の画像もキャッシュから取り出して使い回す
+            img = pg.transform.flip(self.get(path, size, False, alpha), True, False)
+        else:
+            img = self._decode(path, alpha)
+            if size is not None and img.get_size() != size:
+                img = pg.transform.scale(img, size)
+                self.scales += 1
+        self._variants[key] = img
+        return img
+
+    def mask(self, path, size=None, flip=False):
+        """
+        get() と同じ画像の不透明な部分を表す pg.mask.Mask（ピクセル単位の当たり判定用）
+        画面がなくても作れるよう、convert していない画像（_load のキャッシュ）から作る
+        """
+        key = (path, size, flip)
+        mask = self._masks.get(key)
+        if mask is None:
+            img = self._load(path)
+            if size is not None and img.get_size() != size:
+                img = pg.transform.scale(img, size)
+            if flip:
+                img = pg.transform.flip(img, True, False)
+            mask = self._masks[key] = pg.mask.from_surface(img)
+        return mask
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "decodes": self.decodes, "scales": self.scales,
+                "variants": len(self._variants)}
+
+
+ASSETS = AssetCache()
+
+
+def start_screen_asset_keys():
+    """スタート画面で使う画像 (パス, サイズ, 反転, alpha)"""
+    return ([(BG_IMAGE, (WIDTH, HEIGHT), False, False)]
+            + [(path, (60, 60), False, True) for path in ITEM_IMAGES.values()])
+
+
+def sprite_asset_keys(assets=ASSETS):
+    """ゲーム中に使う全ての画像の組み合わせ (パス, サイズ, 反転, alpha)。スタート画面の分が先頭"""
+    keys = start_screen_asset_keys()
+    for path, height in PLAYER_IMAGES.values():
+        size = assets.size_for_height(path, height)
+        keys += [(path, size, False, True), (path, size, True, True)]
+    for path in ENEMY_KINDS:
+        size = assets.size_for_height(path, Enemy_base_height)
+        keys += [(path, size, False, True), (path, size, True, True)]
+    size = assets.size_for_height(FALLING_ENEMY_IMAGE, FallingEnemy_base_height)
+    keys.append((FALLING_ENEMY_IMAGE, size, True, True))
+    for path in ITEM_IMAGES.values():
+        keys.append((path, (40, 40), False, True))
+    for path in PROJECTILE_IMAGES.values():
+        size = assets.size_for_width(path, PROJECTILE_WIDTH)
+        keys += [(path, size, False, True), (path, size, True, True)]
+    keys += [(HATENA_IMAGE, (40, 40), False, True), (HATENA_EMPTY_IMAGE, (40, 40), False, True),
+             (GOAL_IMAGE, (40, 80), False, True)]
+    return keys
+
+
+def mask_asset_keys(assets=ASSETS):
+    """ピクセル単位の当たり判定 (--pixel-collisions) で使うマスクの (パス, サイズ, 反転)"""
+    paths = ({path for path, _ in PLAYER_IMAGES.values()} | set(ENEMY_KINDS) | {FALLING_ENEMY_IMAGE}
+             | set(PROJECTILE_IMAGES.values()))
+    return [(path, size, flip) for path, size, flip, alpha in sprite_asset_keys(assets) if path in paths]
+
+
+def warm_sprite_assets(assets=ASSETS, masks=False):
+    """
+    ゲーム中に使う全ての画像の組み合わせを事前に作っておく
+    masks: True なら当たり判定のマスクも作っておく（プレイ中に初めて重なったときに作らない）
+    """
+    for path, size, flip, alpha in sprite_asset_keys(assets):
+        assets.get(path, size, flip, alpha)
+    if masks:
+        for key in mask_asset_keys(assets):
+            assets.mask(*key)
+
+
+class AssetLoader:
+    """
+    warm_sprite_assets をバックグラウンドのスレッドで行う
+    スタート画面の画像を先に読み込むので、start_ready になればスタート画面を描ける
+    その間もメインのスレッドは読み込み画面を描き続けられる
+    """
+    def __init__(self, assets=ASSETS, masks=False):
+        """masks: True なら当たり判定のマスクも作る（--pixel-collisions のとき）"""
+        self.assets = assets
+        self.keys = sprite_asset_keys(assets)
+        self.mask_keys = mask_asset_keys(assets) if masks else []
+        self.total = len(self.keys) + len(self.mask_keys)
+        self.start_count = len(start_screen_asset_keys())
+        self.loaded = 0
+        self.stages = []  # 画像も用意しておくステージ（warm_stage_assets に渡す）
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self, stages=()):
+        self.stages = list(stages)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for path, size, flip, alpha in self.keys:
+                self.assets.get(path, size, flip, alpha)
+                self.loaded += 1
+            for key in self.mask_keys:
+                self.assets.mask(*key)
+                self.loaded += 1
+        except Exception as e:  # 読み込みに失敗したらメインのスレッドで投げ直す
+            self.error = e
+        for stage in self.stages:
+            # ステージの画像は描くときにも用意できるので、失敗しても起動は続ける
+            try:
+                warm_stage_assets(stage, self.assets)
+            except Exception as e:
+                print(f"ステージの画像を用意できませんでした ({e!r})", file=sys.stderr)
+        self.loaded = self.total + 1
+
+    @property
+    def progress(self):
+        """0〜1 の進み具合"""
+        return min(1.0, self.loaded / (self.total + 1))
+
+    @property
+    def start_ready(self):
+        return self.loaded >= self.start_count
+
+    @property
+    def done(self):
+        return self.loaded > self.total
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+
 class Player:
-    def __init__(self, x, y):
+    def __init__(self, x, y, timers=None):
+        """timers: 能力と無敵時間の終わりを登録する TimerWheel（World が渡す。省略時は自分用を作る）"""
         self.rect = pg.Rect(x, y, 50, Player_base_height) # 当たり判定の初期サイズ
         self.vx = 0
         self.vy = 0
@@ -41,45 +339,37 @@ class Player:
         self.base_jump_power = self.jump_power
         self.jump_enabled = True
         #パワーアップ状態
-        self.power_time = 0.0
+        self.timers = timers if timers is not None else TimerWheel()
+        self.power_timer = None  # 能力が切れるタイマーの id
         self.can_kill_on_touch = False
-        # 衝突後の短い無敵フレーム（秒）
-        self.invul_time = 0.0
-
-        def load_and_resize_image(path, Player_base_height):
-            """画像を読み込み、アスペクト比を維持してリサイズする"""
-            img = pg.image.load(path).convert_alpha()
-            orig_w, orig_h = img.get_size()
-            aspect_ratio = orig_w / orig_h
-            new_width = int(Player_base_height * aspect_ratio)
-            return pg.transform.scale(img, (new_width, Player_base_height))
-
-
-        # 画像の読み込みとリサイズを効率化
-        # (画像パス, 高さ) のタプルで指定
-        image_paths = {
-            'normal': ("img/penguin_right.png", 70),
-            'fire':   ("img/power/penguin_honoo.png", 90),
-            'ice':    ("img/power/penguin_koori.png", 90),
-            'jump':   ("img/power/penguin_usagi.png", 90),
-            'speed':  ("img/power/penguin_speed.png", 50),
-            'muteki': ("img/power/penguin_muteki.png", 70),
-        }
-       
-        # 能力名と画像のペアを辞書にまとめる
-        self.power_images = {
-            key: {'right': load_and_resize_image(path, height),
-                  'left': pg.transform.flip(load_and_resize_image(path, height), True, False)}
-            for key, (path, height) in image_paths.items()
-        }
-        self.power_images[None] = self.power_images.pop('normal') # 通常状態のキーをNoneに
-        self.image = self.power_images[None]['right'] # 初期画像を設定
-       
-    def handle_input(self, keys):
+        # 衝突後の短い無敵時間が終わるタイマーの id
+        self.invul_timer = None
+        # これより左には行けない（スクロールするときはカメラの左端）
+        self.min_x = 0
+
+    def sprite_key(self):
+        """現在の能力と向きに応じた画像の (パス, サイズ, 反転)"""
+        path, height = PLAYER_IMAGES.get(self.power, PLAYER_IMAGES[None])
+        return path, ASSETS.size_for_height(path, height), self.direction == "left"
+
+    @property
+    def image(self):
+        """現在の能力と向きに応じた画像（描画するときだけ読み込まれる）"""
+        return ASSETS.get(*self.sprite_key())
+
+    def hitmask(self):
+        """画像のマスクと、その左上の位置（画像は足元中央を rect に合わせて描く）"""
+        path, size, flip = self.sprite_key()
+        draw_rect = pg.Rect((0, 0), size)
+        draw_rect.midbottom = self.rect.midbottom
+        return ASSETS.mask(path, size, flip), draw_rect.topleft
+
+    def handle_input(self, inp):
+        """inp: InputState"""
         self.vx = 0
-        if keys[pg.K_LEFT] or keys[pg.K_a]:
+        if inp.left:
             self.vx = -self.speed
-        if keys[pg.K_RIGHT] or keys[pg.K_d]:
+        if inp.right:
             self.vx = self.speed
         if self.vx > 0:
             self.direction = "right"
@@ -87,7 +377,7 @@ class Player:
         if self.vx < 0:
             self.direction = "left"
             self.facing = -1
-        if (keys[pg.K_SPACE]) and self.on_ground:
+        if inp.jump and self.on_ground:
             self.vy = -self.jump_power
             self.on_ground = False
        
@@ -96,18 +386,33 @@ class Player:
         if self.vy > 20:
             self.vy = 20
     
+    @property
+    def power_time(self):
+        """能力の残り時間（秒）"""
+        return self.timers.remaining(self.power_timer) * SIM_DT
+
+    @property
+    def invul_time(self):
+        """衝突後の無敵時間の残り（秒）"""
+        return self.timers.remaining(self.invul_timer) * SIM_DT
+
     def apply_power(self, power: str, duration: float = 8.0):
         """
         プレイヤーに数秒間パワーアップを適用します。
         power: 'fire','ice','jump','suberu','muteki'
+        切れる時刻は timers に "power_end" として登録する
         """
+        self._set_power(power)
+        self.timers.cancel(self.power_timer)
+        self.power_timer = self.timers.schedule(seconds_to_ticks(duration), "power_end")
+
+    def _set_power(self, power):
         # 以前のクラスをリセットする
         self.speed = self.base_speed
         self.jump_power = self.base_jump_power
         self.jump_enabled = True
         self.can_kill_on_touch = False
         self.power = power
-        self.power_time = float(duration)
         if power == 'fire' or power == 'ice':
             self.can_kill_on_touch = True
         elif power == 'jump':
@@ -119,31 +424,27 @@ class Player:
             # muteki: 敵の衝突を無視（無敵状態）
             pass
 
-    def update_power(self, dt: float):
-        if self.power is not None:
-            self.power_time -= dt
-            if self.power_time <= 0:
-                self.clear_power()
+    def start_invul(self, duration: float = INVUL_TIME):
+        """能力を失ったときに、少しの間だけ敵に当たっても平気にする"""
+        self.timers.cancel(self.invul_timer)
+        self.invul_timer = self.timers.schedule(seconds_to_ticks(duration), "invul_end")
 
-    def update(self, platforms, hatena_platforms, items):
+    def update(self, tiles, hatena_platforms, items):
+        """tiles: 足場の TileMap"""
         self.rect.x += int(self.vx)
-        self._collide(self.vx, 0, platforms, hatena_platforms, items)
+        self._collide(self.vx, 0, tiles, hatena_platforms, items)
         self.apply_gravity()
         self.rect.y += int(self.vy)
         self.on_ground = False
         # 画面の左端から出ないようにする
-        if self.rect.left < 0:
-            self.rect.left = 0
-        self._collide(0, self.vy, platforms, hatena_platforms, items)
+        if self.rect.left < self.min_x:
+            self.rect.left = self.min_x
+        self._collide(0, self.vy, tiles, hatena_platforms, items)
     
-    def _collide(self, vx, vy, platforms, hatena_blocks=None, items=None):
-        for p_obj in platforms: # platforms は hatena_platforms を含まないようにする
-            # p_objがRectか、rect属性を持つオブジェクトかを判定
-            p_rect = p_obj if isinstance(p_obj, pg.Rect) else p_obj.rect
+    def _collide(self, vx, vy, tiles, hatena_blocks=None, items=None):
+        # 押し戻しで動いた先の足場も拾えるよう、移動量の上限だけ広く探す
+        for p_rect in tiles.candidates(self.rect, margin=20):
             if self.rect.colliderect(p_rect):
-                # ゴールオブジェクトとの衝突時は物理的な反発をしない
-                if isinstance(p_obj, Goal):
-                    continue
                 if vx > 0:  # 右
                     self.rect.right = p_rect.left
                 if vx < 0:  # 左
@@ -167,45 +468,80 @@ class Player:
 
     def clear_power(self):
         """能力が切れたら、基本ステータスに戻す"""
-        self.power = None
-        self.power_time = 0.0
-        self.speed = self.base_speed
-        self.jump_power = self.base_jump_power
-        self.jump_enabled = True
-        self.can_kill_on_touch = False
+        self.timers.cancel(self.power_timer)
+        self.power_timer = None
+        self._set_power(None)
 
-    def draw(self, surf):
-        # 辞書を使って、現在の能力と向きに応じた画像を効率的に選択
-        image_set = self.power_images.get(self.power, self.power_images[None])
-        self.image = image_set[self.direction]
+    def state(self):
+        """
+        画像を含まない状態（World.save_state 用）。速さやジャンプ力は能力から決まるので含めない
+        能力と無敵時間はタイマーの id だけを持つ（タイマー自体は TimerWheel の状態に含まれる）
+        """
+        return (self.rect.x, self.rect.y, self.vx, self.vy, self.on_ground, self.direction, self.facing,
+                self.power, self.power_timer, self.invul_timer, self.min_x)
+
+    @classmethod
+    def from_state(cls, state, timers=None):
+        """timers: state と一緒に保存した状態に戻した TimerWheel"""
+        x, y, vx, vy, on_ground, direction, facing, power, power_timer, invul_timer, min_x = state
+        player = cls(x, y, timers)
+        player._set_power(power)
+        player.power_timer = power_timer
+        player.invul_timer = invul_timer
+        player.vx, player.vy, player.on_ground = vx, vy, on_ground
+        player.direction, player.facing = direction, facing
+        player.min_x = min_x
+        player.prev_pos = player.rect.topleft
+        return player
+
+    def blit_args(self, alpha=1.0, offset_x=0):
+        """描画する (画像, 左上の座標)"""
+        image = self.image
         # 画像の足元中央を、当たり判定(rect)の足元中央に合わせる
-        draw_rect = self.image.get_rect()
-        draw_rect.midbottom = self.rect.midbottom
-        surf.blit(self.image, draw_rect)
+        return image, midbottom_pos(image, self.rect, *interpolated_pos(self, alpha, offset_x))
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
 
 
 class Enemy:
-    def __init__(self, x, y, w=40, h=40, left_bound=None, right_bound=None):
-        # 元画像を2つロードランダムでどちらか選ぶ
-        img_sirokuma = pg.image.load("img/sirokuma.png").convert_alpha()
-        img_kame = pg.image.load("img/kame.png").convert_alpha()
-        img_right_orig = random.choice([img_sirokuma, img_kame])
-
-        # 元画像の比率を計算し、ペンギンの高さを基準に新しいサイズを算出
-        orig_w, orig_h = img_right_orig.get_size()
-        size = (int(Enemy_base_height * orig_w / orig_h), Enemy_base_height)
-        if img_right_orig == img_sirokuma:
-            self.vx = -3
-        else:   
-            self.vx = -1
+    def __init__(self, x, y, w=40, h=40, left_bound=None, right_bound=None, rng=random, image_path=None):
+        self.prev_pos = None
+        # 2種類の敵からランダムでどちらか選ぶ（image_path を指定したときは乱数を使わない）
+        self.image_path = image_path or rng.choice(list(ENEMY_KINDS))
+        self.vx = ENEMY_KINDS[self.image_path]
         self.left_bound = left_bound
         self.right_bound = right_bound
-        self.image_right = pg.transform.scale(img_right_orig, size) # 計算後のサイズでリサイズ
-        self.image_left = pg.transform.flip(self.image_right, True, False)
-        self.image = self.image_left # 初期画像は左向き
-        self.rect = self.image.get_rect(bottomleft=(x, y)) # y座標（足元）を基準に配置
+        # 元画像の比率を維持し、基準の高さに合わせたサイズを使う
+        self.size = ASSETS.size_for_height(self.image_path, Enemy_base_height)
+        self.rect = pg.Rect((0, 0), self.size)
+        self.rect.bottomleft = (x, y) # y座標（足元）を基準に配置
+
+    def state(self):
+        return (self.rect.x, self.rect.bottom, self.vx, self.image_path, self.left_bound, self.right_bound)
+
+    @classmethod
+    def from_state(cls, state):
+        x, bottom, vx, image_path, left_bound, right_bound = state
+        enemy = cls(x, bottom, left_bound=left_bound, right_bound=right_bound, image_path=image_path)
+        enemy.vx = vx
+        return enemy
+
+    def sprite_key(self):
+        # 元画像は右向き。左に進んでいるときは反転した画像を使う
+        return self.image_path, self.size, self.vx < 0
+
+    @property
+    def image(self):
+        return ASSETS.get(*self.sprite_key())
+
+    def hitmask(self):
+        draw_rect = pg.Rect((0, 0), self.size)
+        draw_rect.midbottom = self.rect.midbottom
+        return ASSETS.mask(*self.sprite_key()), draw_rect.topleft
        
-    def update(self, platforms):
+    def update(self, tiles):
+        """tiles: 足場の TileMap"""
         # 水平移動
         self.rect.x += self.vx
 
@@ -218,11 +554,11 @@ class Enemy:
         elif self.vx < 0: # 左向き
             ground_check_pos = (self.rect.left, self.rect.bottom + 1)
  
-        on_ground = any(p.collidepoint(ground_check_pos) for p in platforms)
+        on_ground = tiles.solid_at(*ground_check_pos)
 
         # 壁との衝突チェック
         collided_wall = False
-        for p in platforms:
+        for p in tiles.candidates(self.rect):
             if self.rect.colliderect(p)and self.rect.bottom > p.top: # 上に乗っているだけの場合は無視
                 if self.vx > 0 and self.rect.right > p.left and self.rect.left < p.left: # 右の壁
                     self.rect.right = p.left
@@ -230,60 +566,88 @@ class Enemy:
                 elif self.vx < 0 and self.rect.left < p.right and self.rect.right > p.right: # 左の壁
                     self.rect.left = p.right
                     collided_wall = True
-        # 崖っぷちまたは壁に衝突したまたは画面外の場合 
-        if not on_ground or collided_wall or self.rect.left < 0 or self.rect.right > WIDTH:
+        # 崖っぷちまたは壁に衝突したまたは画面外（スクロール時は自分のチャンクの外）の場合
+        left = 0 if self.left_bound is None else self.left_bound
+        right = WIDTH if self.right_bound is None else self.right_bound
+        if not on_ground or collided_wall or self.rect.left < left or self.rect.right > right:
                
                 self.vx *= -1 # 進行方向を反転
-                self.image = self.image_right if self.vx > 0 else self.image_left
     
-    def draw(self, surf):
-        draw_rect = self.image.get_rect()
-        draw_rect.midbottom = self.rect.midbottom
-        surf.blit(self.image, draw_rect)
+    def blit_args(self, alpha=1.0, offset_x=0):
+        image = self.image
+        return image, midbottom_pos(image, self.rect, *interpolated_pos(self, alpha, offset_x))
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
 
 
 # 落ちてくる敵
 class FallingEnemy:
     def __init__(self, x, y, w=40, h=40, speed=2):
         self.rect = pg.Rect(x, y, w, h)
+        self.reset(x, y, w, h, speed)
+
+    def reset(self, x, y, w=40, h=40, speed=2):
+        """画面の下に消えたものを、作り直さずに出し直す"""
+        self.rect.update(x, y, w, h)
+        self.prev_pos = None
         self.vy = speed  # 落下速度
-        img_koura = pg.image.load("img/koura.png").convert_alpha()
-        orig_w, orig_h = img_koura.get_size()
-        size = (int(FallingEnemy_base_height * orig_w / orig_h), FallingEnemy_base_height)
-        self.image_right = pg.transform.scale(img_koura, size) # 計算後のサイズでリサイズ
-        self.image_left = pg.transform.flip(self.image_right, True, False)
-        self.image = self.image_left
+
+    def state(self):
+        """FallingEnemy(*state) で同じものを作れる"""
+        return (self.rect.x, self.rect.y, self.rect.width, self.rect.height, self.vy)
+
+    def sprite_key(self):
+        return FALLING_ENEMY_IMAGE, ASSETS.size_for_height(FALLING_ENEMY_IMAGE, FallingEnemy_base_height), True
+
+    @property
+    def image(self):
+        return ASSETS.get(*self.sprite_key())
+
+    def hitmask(self):
+        return ASSETS.mask(*self.sprite_key()), self.rect.topleft
 
     def update(self):
-        self.rect.y += self.vy  # 下に落ちる
-        # 画面外に出たら,球にあたって衝突したら上にリセット
-        if self.rect.top > HEIGHT:
-            self.rect.bottom = 0
+        # 下に落ちる。画面の下に出たら World が消して、少し後に上から出し直す（"respawn_falling"）
+        self.rect.y += self.vy
 
-    def draw(self, surf):
-        surf.blit(self.image, self.rect)
+    def blit_args(self, alpha=1.0, offset_x=0):
+        return self.image, interpolated_pos(self, alpha, offset_x)
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
 
 
 # アイテムクラス
 class Item:
     def __init__(self, x, y, kind, duration=10, w=40, h=40):
         self.rect = pg.Rect(x, y, w, h) #
+        self.reset(x, y, kind, duration, w, h)
+
+    def reset(self, x, y, kind, duration=10, w=40, h=40):
+        """ObjectPool で使い回すときに、作り直さずに初期状態へ戻す"""
+        self.rect.update(x, y, w, h)
+        self.prev_pos = None
         self.kind = kind  # 'fire','ice','jump','suberu','muteki'
         self.duration = duration
 
-        # アイテムの種類に応じた画像を辞書に格納
-        self.image_map = {
-            'fire': pg.transform.scale(pg.image.load("img/item/honoo-item.png").convert_alpha(), (w, h)),
-            'ice': pg.transform.scale(pg.image.load("img/item/koori-item.png").convert_alpha(), (w, h)),
-            'jump': pg.transform.scale(pg.image.load("img/item/jamp-item.png").convert_alpha(), (w, h)),
-            'speed': pg.transform.scale(pg.image.load("img/item/speedup-item.png").convert_alpha(), (w, h)),
-            'muteki': pg.transform.scale(pg.image.load("img/item/muteki-item.png").convert_alpha(), (w, h))
-        }
-        # 現在のアイテム画像を設定
-        self.image = self.image_map.get(self.kind)
+    def state(self):
+        """reset() の引数と同じ並び（ObjectPool.acquire(*state) で戻せる）"""
+        return (self.rect.x, self.rect.y, self.kind, self.duration, self.rect.width, self.rect.height)
+
+    def sprite_key(self):
+        # アイテムの種類に応じた画像
+        return ITEM_IMAGES[self.kind], self.rect.size, False
 
-    def draw(self, surf):
-        surf.blit(self.image, self.rect)
+    @property
+    def image(self):
+        return ASSETS.get(*self.sprite_key())
+
+    def blit_args(self, alpha=1.0, offset_x=0):
+        return self.image, interpolated_pos(self, alpha, offset_x)
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
 
 
 # ハテナブロック
@@ -291,25 +655,36 @@ class HatenaBlock:
     """
     アイテムを内包するはてなブロックのクラス
     """
-    def __init__(self, x, y):
+    def __init__(self, x, y, rng=random):
         self.rect = pg.Rect(x, y, 40, 40)
         self.used = False
-         # 画像のロード
-        self.image_hatena = pg.transform.scale(pg.image.load("img/hatena.png").convert_alpha(), (40, 40)) # This is defined but not used.
-        # 画像（self.image_hatena）を白黒にしたものをからのハテナブロックとする
-        self.image_empty = pg.transform.scale(pg.image.load("img/hatena_empty.png").convert_alpha(), (40, 40))
-        self.image = self.image_hatena
+        self.rng = rng
+        self.item_pool = None  # World が ObjectPool を設定する
+        self.timers = None  # World が TimerWheel を設定する（なければすぐにアイテムを出す）
+
+    @property
+    def image(self):
+        # 使用済みなら白黒にした空のハテナブロックの画像
+        return ASSETS.get(HATENA_EMPTY_IMAGE if self.used else HATENA_IMAGE, (40, 40))
 
     def activate(self, items):
         if not self.used:
             self.used = True
-            kind = random.choice(["fire", "ice", "jump", "speed", "muteki"])
-            item = Item(self.rect.centerx - 20, self.rect.top - 40, kind)
-            items.append(item)
-            self.image = self.image_empty
+            kind = self.rng.choice(["fire", "ice", "jump", "speed", "muteki"])
+            x, y = self.rect.centerx - 20, self.rect.top - 40
+            if self.timers is not None:
+                # 少し遅れて出てくる（World が "reveal_item" で items に加える）
+                self.timers.schedule(seconds_to_ticks(ITEM_REVEAL_TIME), "reveal_item", x, y, kind)
+            elif self.item_pool is not None:
+                items.append(self.item_pool.acquire(x, y, kind))
+            else:
+                items.append(Item(x, y, kind))
+
+    def blit_args(self, alpha=1.0, offset_x=0):
+        return self.image, interpolated_pos(self, alpha, offset_x)
 
-    def draw(self, surf):
-        surf.blit(self.image, self.rect)
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
 
 
 class PowerUpDisplay: 
@@ -320,498 +695,2536 @@ class PowerUpDisplay:
         self.pos = pos
         self.size = size
         # アイテムの種類に応じた画像を辞書に格納
-        self.image_map = {
-            'fire': pg.transform.scale(pg.image.load("img/item/honoo-item.png").convert_alpha(), self.size),
-            'ice': pg.transform.scale(pg.image.load("img/item/koori-item.png").convert_alpha(), self.size),
-            'jump': pg.transform.scale(pg.image.load("img/item/jamp-item.png").convert_alpha(), self.size),
-            'speed': pg.transform.scale(pg.image.load("img/item/speedup-item.png").convert_alpha(), self.size),
-            'muteki': pg.transform.scale(pg.image.load("img/item/muteki-item.png").convert_alpha(), self.size)
-        }
+        self.image_map = {kind: ASSETS.get(path, self.size) for kind, path in ITEM_IMAGES.items()}
 
     def draw(self, surf, current_power):
         image = self.image_map.get(current_power)
         if image:
-            surf.blit(image, self.pos)
+            return surf.blit(image, self.pos)
+        return None
 
 
 class Projectile:
     """プレイヤーが火/氷の力を持っているときに発射する弾"""
     def __init__(self, x, y, kind: str, direction: int, speed: float = 10.0):
         self.rect = pg.Rect(int(x), int(y), 10, 10)
+        self.reset(x, y, kind, direction, speed)
+
+    def reset(self, x, y, kind: str, direction: int, speed: float = 10.0):
+        """ObjectPool で使い回すときに、作り直さずに初期状態へ戻す"""
+        self.rect.topleft = (int(x), int(y))
+        self.prev_pos = None
         self.kind = kind
         self.vx = speed * (1 if direction >= 0 else -1)
-        # 画像のロード
-        if self.kind == 'fire':
-            self.image = pg.image.load("img/fireball.png").convert_alpha()
-        elif self.kind == 'ice':
-            self.image = pg.image.load("img/iceball.png").convert_alpha()
+
+    def state(self):
+        """reset() の引数と同じ並び（ObjectPool.acquire(*state) で戻せる）"""
+        return (self.rect.x, self.rect.y, self.kind, 1 if self.vx >= 0 else -1, abs(self.vx))
+
+    def sprite_key(self):
         # 画像の元の比率でリサイズ
-        orig_w, orig_h = self.image.get_size()
-        self.image = pg.transform.scale(self.image, (50, int(50 * orig_h / orig_w)))
+        path = PROJECTILE_IMAGES[self.kind]
+        size = ASSETS.size_for_width(path, PROJECTILE_WIDTH)
         # 右向きに発射される場合のみ画像を反転させる（元画像が左向きのため）
-        if self.vx > 0:
-            self.image = pg.transform.flip(self.image, True, False)
+        return path, size, self.vx > 0
+
+    @property
+    def image(self):
+        return ASSETS.get(*self.sprite_key())
+
+    def hitmask(self):
+        return ASSETS.mask(*self.sprite_key()), self.rect.topleft
     
     def update(self):
         self.rect.x += int(self.vx)
 
-    def draw(self, surf):
-        surf.blit(self.image, self.rect)
+    def blit_args(self, alpha=1.0, offset_x=0):
+        return self.image, interpolated_pos(self, alpha, offset_x)
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
+
+
+def sprites_overlap(a, b):
+    """
+    a と b の画像の不透明な部分が重なっているか（ピクセル単位の当たり判定）
+    rect どうしが重なったものだけに使う。マスクは画像ごとにキャッシュされている
+    """
+    mask_a, (ax, ay) = a.hitmask()
+    mask_b, (bx, by) = b.hitmask()
+    return mask_a.overlap(mask_b, (bx - ax, by - ay)) is not None
 
 
 class Goal(pg.sprite.Sprite):
     def __init__(self, x, y, w, h):
         self.rect = pg.Rect(x, y, w, h)
+
+    @property
+    def image(self):
         # ゴール画像
-        self.goal_img = pg.image.load("img/goal_pole.png").convert_alpha()
-        self.image = pg.transform.scale(self.goal_img, (w, h))
-
-    def draw(self, surf):
-        surf.blit(self.image, self.rect)
-# ground_size_y = 40
-# floating_saize_y = 50
-
-def build_stage1():
-    """
-    1つ目のステージを生成する関数
-    戻り値：地面・浮島・はてなブロック・敵のリスト(以下build関数は同文)
-    """
-    ground_platforms = [
-        pg.Rect(0, ground_y, 200, 40),
-        pg.Rect(250, ground_y, 50, 40),
-        pg.Rect(350, ground_y, 50, 40),
-        pg.Rect(500, ground_y, 50, 40),
-        pg.Rect(600, ground_y, 50, 40),
-        pg.Rect(700, ground_y, WIDTH, 40)
-    ]
-    floating_platforms = [
-        pg.Rect(100, 500, 50, 50),
-        pg.Rect(250, 400, 150, 50)
-    ]
-    hatena_platforms = [HatenaBlock(350, 300)]
-    enemies = [Enemy(700, ground_y)]
-    items = []
-    goal_platforms = []
-    falling_enemies = []
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage2():
-    """2つ目のステージを生成する関数"""
-    ground_platforms = [
-        pg.Rect(0, ground_y, 550, 40),
-        pg.Rect(650, ground_y, 150, 40)
-    ]
-    floating_platforms = [
-        pg.Rect(200, 500, 50, 50),
-        pg.Rect(300, 400, 50, 50),
-        pg.Rect(400, 300, 50, 50),
-        pg.Rect(500, 200, 50, 50),
-        pg.Rect(650, 350, 50, 50),
-        pg.Rect(800, 350, 100, 50)
-    ]
-    hatena_platforms = []
-    enemies = [Enemy(800, ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(250, 0, speed=2), FallingEnemy(700, -200, speed=2)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage3():
-    """3つ目のステージを生成する関数"""
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    floating_platforms = [
-        pg.Rect(0, 200, 250, 50),
-        pg.Rect(300, 350, 200, 50),
-        pg.Rect(600, 450, 250, 50)
-    ]
-    hatena_platforms = [
-        HatenaBlock(50, 100),
-        HatenaBlock(700, 350)
-    ]
-    enemies = [Enemy(WIDTH-100, y=ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(150, 0, speed=2), FallingEnemy(550, -200, speed=2)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage4():
-    """4つ目のステージを生成する関数"""
-    hatena_platforms = []
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    floating_platforms = [
-        pg.Rect(100, ground_y-50, 50, 50),
-        pg.Rect(200, 400, 100, 50),
-        pg.Rect(350, 300, 50, 50),
-        pg.Rect(450, 200, 100, 50),
-        pg.Rect(600, 100, 50, 50),
-        pg.Rect(700, 200, 50, 50),
-        pg.Rect(800, 100, 50, 50)
-    ]
-    enemies = [Enemy(x=800, y=ground_y), Enemy(x=750, y=ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(150, 0, speed=3), FallingEnemy(450, -200, speed=3)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage5():
-    """5つ目のステージを生成する関数"""
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    floating_platforms = [
-        pg.Rect(150, 500, 50, 50),
-        pg.Rect(200, 450, 50, 50),
-        pg.Rect(250, 400, 50, 50),
-        pg.Rect(750, 450, 50, 50),
-        pg.Rect(800, 450, 100, 50),
-        pg.Rect(400, 300, 150, 50),
-        pg.Rect(650, 200, 250, 50)
-    ]
-    hatena_platforms = [HatenaBlock(750, 90)]
-    enemies = [Enemy(x=800, y=ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(300, 0, speed=2), FallingEnemy(600, -150, speed=2)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage6():
-    """6つ目のステージを生成する関数"""
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    floating_platforms = [
-        pg.Rect(0, 500, 50, 50),
-        pg.Rect(350, 500, 200, 50),
-        pg.Rect(300, 300, 250, 50),
-        pg.Rect(650, 400, 50, 50),
-        pg.Rect(700, 450, 200, 50)
-    ]
-    hatena_platforms = [HatenaBlock(400, 190)]
-    enemies = [Enemy(x=700, y=ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(150, 0, speed=2), FallingEnemy(550, -150, speed=2)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage7():
-    """7つ目のステージを生成する関数"""
-    ground_platforms = [
-        pg.Rect(0, ground_y, 250, 40),
-        pg.Rect(350, ground_y, 350, 40),
-        pg.Rect(800, ground_y, 100, 40)
-    ]
-    floating_platforms = []
-    hatena_platforms = [HatenaBlock(150, 440)]
-    enemies = []
-    goal_platforms = []
-    items = []
-    falling_enemies = []
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage8():
-    """8つ目のステージを生成する関数"""
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    floating_platforms = [
-        pg.Rect(150, 500, 50, 50),
-        pg.Rect(200, 400, 250, 50),
-        pg.Rect(750, 500, 50, 50),
-        pg.Rect(500, 400, 250, 50)
-    ]
-    hatena_platforms = [HatenaBlock(WIDTH/2, 290)]
-    enemies = [Enemy(700, ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(200, 0, speed=2)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage9():
-    """9つ目のステージを生成する関数"""
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    floating_platforms = [pg.Rect(150, 450, 150, 50),pg.Rect(300, 350, 150, 50), pg.Rect(400, 250, 150, 50),pg.Rect(500, 350, 150, 50),pg.Rect(650, 450, 150, 50)]
-    hatena_platforms = []
-    enemies = [Enemy(300, ground_y)]
-    goal_platforms = []
-    items = []
-    falling_enemies = []
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
-
-def build_stage10():
-    """10つ目のステージを生成する関数"""
-    ground_platforms = [pg.Rect(0, ground_y, 550, 40),pg.Rect(650, ground_y, 250, 40)]
-    floating_platforms = [pg.Rect(150, 500, 400, 50),pg.Rect(250, 450, 300, 50),pg.Rect(350, 400, 200, 50),pg.Rect(450, 350, 100, 50),pg.Rect(650, 350, 250, 50),pg.Rect(700, 300, 200, 50)]
-    hatena_platforms = []
-    enemies = []
-    goal_platforms = []
-    items = []
-    falling_enemies = [FallingEnemy(750, 0, speed=2)]
-    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies
+        return ASSETS.get(GOAL_IMAGE, self.rect.size)
+
+    def blit_args(self, alpha=1.0, offset_x=0):
+        return self.image, interpolated_pos(self, alpha, offset_x)
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
+STAGE_DIR = os.path.join(BASE_DIR, "stages")
+STAGE_CACHE_DIR = os.path.join(STAGE_DIR, "__stagecache__")
+STAGE_CACHE_MAGIC = b"NAS1"
+# ステージファイルの項目と、1要素あたりの数値の個数
+STAGE_FIELDS = (
+    ("ground", 4),           # 地面 [x, y, 幅, 高さ]
+    ("floating", 4),         # 浮遊ブロック [x, y, 幅, 高さ]
+    ("hatena", 2),           # ハテナブロック [x, y]
+    ("enemies", 2),          # 左右に動く敵 [x, 足元のy]
+    ("falling_enemies", 3),  # 落ちてくる敵 [x, y, 落下速度]
+    ("goals", 4),            # ゴール [x, y, 幅, 高さ]
+)
+
 
-def build_gole(): # 関数名を build_gole に修正
+class StageFormatError(ValueError):
+    """ステージファイルの内容が正しくないときのエラー"""
+
+
+def compile_stage(data, name="<stage>"):
+    """
+    JSON から読み込んだ辞書を検査し、数値のタプルだけのコンパクトな形にする
+    戻り値: STAGE_FIELDS の順に並んだ、(x, y, ...) のタプルのタプル
+    """
+    if not isinstance(data, dict):
+        raise StageFormatError(f"{name}: オブジェクトではありません")
+    unknown = set(data) - {field for field, _ in STAGE_FIELDS}
+    if unknown:
+        raise StageFormatError(f"{name}: 不明な項目 {sorted(unknown)}")
+    compiled = []
+    for field, arity in STAGE_FIELDS:
+        entries = data.get(field, [])
+        if not isinstance(entries, list):
+            raise StageFormatError(f"{name}: {field} がリストではありません")
+        rows = []
+        for entry in entries:
+            if (not isinstance(entry, list) or len(entry) != arity
+                    or not all(isinstance(v, int) and not isinstance(v, bool) for v in entry)):
+                raise StageFormatError(f"{name}: {field} の要素 {entry!r} は整数{arity}個のリストにしてください")
+            rows.append(tuple(entry))
+        compiled.append(tuple(rows))
+    return tuple(compiled)
+
+
+def _pack_stage(compiled):
+    """コンパイル済みのステージをバイト列にする（キャッシュファイル用）"""
+    counts = [len(rows) for rows in compiled]
+    values = [v for rows in compiled for row in rows for v in row]
+    return (STAGE_CACHE_MAGIC + struct.pack(f"<{len(counts)}H", *counts)
+            + struct.pack(f"<{len(values)}i", *values))
+
+
+def _unpack_stage(blob):
+    if blob[:4] != STAGE_CACHE_MAGIC:
+        raise StageFormatError("キャッシュの形式が違います")
+    n = len(STAGE_FIELDS)
+    counts = struct.unpack_from(f"<{n}H", blob, 4)
+    offset = 4 + 2 * n
+    compiled = []
+    for (field, arity), count in zip(STAGE_FIELDS, counts):
+        values = struct.unpack_from(f"<{count * arity}i", blob, offset)
+        offset += 4 * count * arity
+        compiled.append(tuple(values[i:i + arity] for i in range(0, len(values), arity)))
+    return tuple(compiled)
+
+
+_compiled_stages = {}  # 内容のハッシュ -> コンパイル済みのステージ
+
+
+def load_stage_file(path):
     """
-    ゴールステージ画面を生成する関数。旗に触れるとゴールする。
-    戻り値：ステージ名、地面のリスト、ゴールのリスト(中身は１つだけ)
+    ステージファイルを読み込んでコンパイル済みの形を返す
+    内容のハッシュをキーにして、メモリと STAGE_CACHE_DIR のバイナリにキャッシュする
     """
-    ground_platforms = [pg.Rect(0, ground_y, WIDTH, 40)]
-    goal_platforms = [Goal(WIDTH - 80, ground_y - 80, 40, 80)]
-    hatena_platforms = []
-    enemies = []
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw).hexdigest()
+    compiled = _compiled_stages.get(digest)
+    if compiled is not None:
+        return compiled
+    cache_path = os.path.join(STAGE_CACHE_DIR, digest + ".bin")
+    try:
+        with open(cache_path, "rb") as f:
+            compiled = _unpack_stage(f.read())
+    except (OSError, StageFormatError, struct.error):
+        compiled = compile_stage(json.loads(raw), path)
+        try:
+            os.makedirs(STAGE_CACHE_DIR, exist_ok=True)
+            with open(cache_path, "wb") as f:
+                f.write(_pack_stage(compiled))
+        except OSError:
+            pass # 書き込めなくてもメモリ上のキャッシュは使える
+    _compiled_stages[digest] = compiled
+    return compiled
+
+
+class StageFile:
+    """
+    ステージファイル1つ分のビルダー。呼び出すとステージを構築する
+    ファイルは最初に呼ばれたときに読み込む
+    戻り値：地面・浮島・はてなブロック・ゴール・敵・アイテム・落ちてくる敵のリスト
+    """
+    def __init__(self, path):
+        self.path = path
+        self.compiled = None
+
+    def __repr__(self):
+        return f"StageFile({self.path!r})"
+
+    def load(self):
+        if self.compiled is None:
+            self.compiled = load_stage_file(self.path)
+        return self.compiled
+
+    def __call__(self, rng=random, offset_x=0):
+        """offset_x: スクロールするときのチャンクの左端。全ての x をこれだけずらす"""
+        return instantiate_stage(self.load(), rng, offset_x)
+
+
+def instantiate_stage(compiled, rng=random, offset_x=0):
+    """
+    compile_stage の形式のステージからオブジェクトを作る
+    戻り値：地面・浮島・はてなブロック・ゴール・敵・アイテム・落ちてくる敵のリスト
+    """
+    ground, floating, hatena, enemies, falling, goals = compiled
+    ground_platforms = [pg.Rect(x + offset_x, y, w, h) for x, y, w, h in ground]
+    floating_platforms = [pg.Rect(x + offset_x, y, w, h) for x, y, w, h in floating]
+    hatena_platforms = [HatenaBlock(x + offset_x, y, rng=rng) for x, y in hatena]
+    goal_platforms = [Goal(x + offset_x, y, w, h) for x, y, w, h in goals]
+    # 敵はステージ（チャンク）の端で折り返す
+    enemy_list = [Enemy(x + offset_x, y, left_bound=offset_x, right_bound=offset_x + WIDTH, rng=rng)
+                  for x, y in enemies]
     items = []
-    falling_enemies = []
-    return ground_platforms, [], hatena_platforms, goal_platforms, enemies, items, falling_enemies
-STAGE_BUILDERS = [ build_stage1, build_stage2, build_stage3, build_stage4, build_stage5,build_stage6, build_stage7, build_stage8, build_stage9, build_stage10, build_gole]
+    falling_enemies = [FallingEnemy(x + offset_x, y, speed=speed) for x, y, speed in falling]
+    return ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemy_list, items, falling_enemies
+
+
+def stage_builders(stage_dir=STAGE_DIR):
+    """stage*.json を名前順に並べ、最後にゴールステージ (goal.json) を加える"""
+    names = sorted(name for name in os.listdir(stage_dir)
+                   if name.startswith("stage") and name.endswith(".json"))
+    return ([StageFile(os.path.join(stage_dir, name)) for name in names]
+            + [StageFile(os.path.join(stage_dir, "goal.json"))])
+
+
+STAGE_BUILDERS = stage_builders()
+
+# 自動生成するチャンクの stage_index（STAGE_BUILDERS の添字の代わりに使う）
+ENDLESS_STAGE = "endless"
+GRID = 50  # 手作りのステージと同じく、足場は50ピクセル単位で置く
+GENERATE_PER_TICK = 1  # 1tickに先読みで生成するチャンクの数
+
+
+@functools.lru_cache(maxsize=32)
+def generate_chunk(seed, number):
+    """
+    seed と チャンクの番号から、手作りのステージと同じ形の1画面分のステージを作る
+    番号が大きいほど穴と敵が増える。同じ (seed, 番号) なら必ず同じものを返す
+    戻り値は compile_stage と同じ形
+    """
+    rng = random.Random(f"{seed}:{number}")
+    level = min(number // 5, 4)  # 難しさ（0〜4）
+    # 地面: 左右の端は必ず地面にして、チャンクのつなぎ目に穴ができないようにする
+    ground = []
+    x = 0
+    while x < WIDTH:
+        w = rng.randrange(3, 9) * GRID
+        if x + w > WIDTH - 3 * GRID:
+            w = WIDTH - x
+        ground.append([x, ground_y, w, HEIGHT - ground_y])
+        x += w
+        if x < WIDTH:
+            x += GRID * (1 if rng.random() < 0.7 - level * 0.1 else 2)  # 穴（ジャンプで越えられる幅）
+    # 浮遊ブロック: 階段状に並べる
+    floating = []
+    x = rng.randrange(2, 6) * GRID
+    y = ground_y - 2 * GRID
+    while x < WIDTH - 2 * GRID and len(floating) < 5:
+        w = min(rng.randrange(1, 6) * GRID, WIDTH - x)
+        floating.append([x, y, w, GRID])
+        x += w + rng.randrange(1, 4) * GRID
+        y = max(4 * GRID, min(ground_y - 2 * GRID, y + rng.choice((-2, -1, 1)) * GRID))
+    # ハテナブロック: 浮遊ブロックの上（なければ地面の上）に1つまで
+    hatena = []
+    if rng.random() < 0.4:
+        if floating:
+            bx, by, bw, _ = rng.choice(floating)
+            hatena.append([bx + (bw - 40) // 2, by - 110])
+        else:
+            hatena.append([rng.randrange(2, 16) * GRID, ground_y - 120])
+    # 敵: 十分な広さの地面の上に置く（最初の地面はプレイヤーの着地点なので避ける）
+    # 低い浮遊ブロックの下は敵の頭がぶつかるので置かない
+    low = [(fx, fx + fw) for fx, fy, fw, fh in floating if fy + fh > ground_y - Enemy_base_height]
+    spots = [x for gx, _, gw, _ in ground[1:] if gw >= 3 * GRID
+             for x in range(gx, gx + gw - 2 * GRID + 1, GRID)
+             if not any(x < right and left < x + 2 * GRID for left, right in low)]
+    enemies = [[x, ground_y] for x in rng.sample(spots, min(len(spots), rng.randint(0, 1 + level)))]
+    falling_enemies = [[rng.randrange(2, 17) * GRID, -i * 200, 2 + (level >= 3)]
+                       for i in range(rng.randint(0, min(2, level)))]
+    data = {"ground": ground, "floating": floating, "hatena": hatena, "enemies": enemies,
+            "falling_enemies": falling_enemies, "goals": []}
+    return compile_stage(data, f"<generated {seed}:{number}>")
+
+
+class EndlessPlan:
+    """
+    終わりのないスクロールステージの並び（ChunkedLevel の plan に使う）
+    最初のチャンクは1つ目のステージ、その後は seed から自動生成する
+    """
+    def __init__(self, seed):
+        self.seed = seed
+
+    def __getitem__(self, number):
+        if number == 0:
+            return (0, self.seed)
+        return (ENDLESS_STAGE, self.seed)
+
+
+class CountingRandom(random.Random):
+    """
+    使った乱数の数 (draws、32bit 単位) を数える random.Random
+    状態（624語）を丸ごと保存しなくても、seed と draws だけで同じ状態に戻せる
+    """
+    def seed(self, a=None, version=2):
+        super().seed(a, version)
+        self.initial_seed = a
+        self.draws = 0
+
+    def random(self):
+        self.draws += 2  # 53bit の小数は32bitの乱数を2つ使う
+        return super().random()
+
+    def getrandbits(self, k):
+        self.draws += (k + 31) // 32
+        return super().getrandbits(k)
+
+    def rewind(self, draws):
+        """seed から draws 個使った状態にする"""
+        super().seed(self.initial_seed)
+        if draws:
+            super().getrandbits(32 * draws) # 32bit の乱数を draws 個まとめて読み飛ばす
+        self.draws = draws
+
+
+# 構築済みのステージ。World はこれを丸ごと差し替えてステージを切り替える
+Stage = namedtuple("Stage", ["index", "ground_platforms", "floating_platforms", "hatena_platforms",
+                             "goal_platforms", "enemies", "items", "falling_enemies", "tiles"])
+
+
+def build_stage(stage_index, seed, offset_x=0):
+    """
+    STAGE_BUILDERS[stage_index] のステージを構築する
+    敵の種類などの乱数はステージごとの seed から作るので、どのスレッドで構築しても結果は同じ
+    offset_x: スクロールするときにステージを置く x 座標
+    """
+    if stage_index == ENDLESS_STAGE:
+        # 自動生成するチャンクは x の位置から番号を求める
+        number = offset_x // WIDTH
+        rng = CountingRandom(f"{seed}:{number}:objects")
+        builder = functools.partial(instantiate_stage, generate_chunk(seed, number))
+    else:
+        rng = CountingRandom(seed)
+        builder = STAGE_BUILDERS[stage_index]
+    (ground_platforms, floating_platforms, hatena_platforms, goal_platforms,
+     enemies, items, falling_enemies) = builder(rng, offset_x=offset_x)
+    # ゴールは物理的に反発しないので足場に含めない
+    tiles = TileMap(ground_platforms + floating_platforms)
+    return Stage(stage_index, ground_platforms, floating_platforms, hatena_platforms,
+                 goal_platforms, enemies, items, falling_enemies, tiles)
+
+
+def warm_stage_assets(stage, assets=ASSETS):
+    """ステージの静的レイヤーで使う、足場の大きさに合わせた画像を用意しておく"""
+    if pg.display.get_surface() is None:
+        return # 画面がない（ヘッドレス）ときは画像を使わない
+    for p in stage.ground_platforms:
+        assets.get(GROUND_IMAGE, p.size)
+    for p in stage.floating_platforms:
+        assets.get(BLOCK_IMAGE, p.size)
+    for p in stage.goal_platforms:
+        assets.get(GOAL_IMAGE, p.rect.size)
+
+
+class StagePrefetcher:
+    """
+    次のステージをバックグラウンドのスレッドで構築し、画像も用意しておく
+    request() で構築を始め、take() で受け取る（まだ終わっていなければ待つ）
+    """
+    def __init__(self):
+        self._key = None
+        self._thread = None
+        self._result = None
+        self.hits = 0
+        self.misses = 0
+
+    def request(self, stage_index, seed, offset_x=0):
+        key = (stage_index, seed, offset_x)
+        if key == self._key:
+            return
+        self._key = key
+        self._result = None
+        self._thread = threading.Thread(target=self._run, args=(key,), daemon=True)
+        self._thread.start()
+
+    def _run(self, key):
+        stage = build_stage(*key)
+        warm_stage_assets(stage)
+        if key == self._key:
+            self._result = stage
+
+    def take(self, stage_index, seed, offset_x=0):
+        """構築済みのステージを返す。別のステージを頼んでいたときは None"""
+        if (stage_index, seed, offset_x) != self._key:
+            self.misses += 1
+            return None
+        self._thread.join()
+        stage = self._result
+        self._key = self._thread = self._result = None
+        if stage is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return stage
+
+
+class Camera:
+    """
+    スクロールするときの画面の左端の x 座標
+    プレイヤーを画面の左から1/3の位置に保ち、前（右）にだけ進む
+    """
+    def __init__(self, level_width=None):
+        self.x = 0
+        self.prev_x = 0  # 前のtickの位置（描画の補間用）
+        self.level_width = level_width  # None なら右端なし
+
+    def follow(self, rect):
+        x = max(self.x, rect.centerx - WIDTH // 3)
+        if self.level_width is not None:
+            x = min(x, self.level_width - WIDTH)
+        self.x = x
+
+    def offset(self, alpha=1.0):
+        """描画に使う位置。前のtickとの間を alpha で補間する"""
+        return round(self.prev_x + (self.x - self.prev_x) * alpha)
+
+
+# スクロールするステージの1画面分。stage は offset_x をずらして構築した Stage
+Chunk = namedtuple("Chunk", ["number", "stage"])
+
+
+class ChunkedLevel:
+    """
+    横に長いステージを画面幅 (WIDTH) ごとのチャンクに分けて持つ
+    カメラの周り（前後 margin）のチャンクだけを構築し、離れたものは捨てるので、
+    ステージがどれだけ長くてもメモリと1tickあたりの処理は変わらない
+    plan: チャンクの番号ごとの (ステージの添字, seed)。長さのないもの (EndlessPlan) なら終わりなし
+    """
+    def __init__(self, plan, margin=WIDTH // 2, prefetcher=None, lookahead=2):
+        self.plan = plan
+        self.length = len(plan) if hasattr(plan, "__len__") else None
+        self.margin = margin
+        self.prefetcher = prefetcher
+        self.lookahead = lookahead
+        self.chunks = {}  # 番号 -> Chunk
+        self.generated = 0  # これより前の番号のチャンクは地形を生成済み
+        self.builds = 0
+
+    @property
+    def width(self):
+        return None if self.length is None else self.length * WIDTH
+
+    def chunk_range(self, camera_x):
+        first = max(0, (camera_x - self.margin) // WIDTH)
+        last = (camera_x + WIDTH + self.margin - 1) // WIDTH
+        if self.length is not None:
+            last = min(self.length - 1, last)
+        return range(first, last + 1)
+
+    def generate_ahead(self, camera_x, budget=1):
+        """
+        カメラの先 lookahead 個までのチャンクの地形を、1回に budget 個まで生成しておく
+        毎tick呼べば、チャンクを構築するときには generate_chunk のキャッシュから取り出すだけになる
+        """
+        target = self.chunk_range(camera_x).stop + self.lookahead
+        if self.length is not None:
+            target = min(target, self.length)
+        while self.generated < target and budget > 0:
+            stage_index, seed = self.plan[self.generated]
+            if stage_index == ENDLESS_STAGE:
+                generate_chunk(seed, self.generated)
+                budget -= 1
+            self.generated += 1
+
+    def stream(self, camera_x):
+        """カメラの位置に必要なチャンクを構築し、いらないものを捨てる。入れ替えがあれば True"""
+        wanted = self.chunk_range(camera_x)
+        if len(self.chunks) == len(wanted) and all(n in self.chunks for n in wanted):
+            return False
+        self.chunks = {n: self.chunk(n) for n in wanted}
+        # 次に入ってくるチャンクを先読みしておく
+        if self.prefetcher is not None and (self.length is None or wanted.stop < self.length):
+            self.prefetcher.request(*self.plan[wanted.stop], wanted.stop * WIDTH)
+        return True
+
+    def chunk(self, number):
+        """番号のチャンク（構築していなければ構築する。chunks には加えない）"""
+        return self.chunks.get(number) or Chunk(number, self._build(number))
+
+    def _build(self, number):
+        stage_index, seed = self.plan[number]
+        stage = None
+        if self.prefetcher is not None:
+            stage = self.prefetcher.take(stage_index, seed, number * WIDTH)
+        if stage is None:
+            stage = build_stage(stage_index, seed, number * WIDTH)
+        self.builds += 1
+        return stage
+
+    def active(self):
+        """構築済みのチャンク（左から順）"""
+        return [self.chunks[n] for n in sorted(self.chunks)]
+
+    def stage_index_at(self, x):
+        number = max(0, x // WIDTH)
+        if self.length is not None:
+            number = min(number, self.length - 1)
+        return self.plan[number][0]
+
+    def discard(self, removed_ids):
+        """倒された・画面の下に消えた敵（id の集合）をチャンクから取り除く"""
+        for chunk in self.chunks.values():
+            stage = chunk.stage
+            stage.enemies[:] = [e for e in stage.enemies if id(e) not in removed_ids]
+            stage.falling_enemies[:] = [fe for fe in stage.falling_enemies if id(fe) not in removed_ids]
+
+
+class ObjectPool:
+    """
+    使い終わったオブジェクトを取っておき、次の acquire() で reset() して使い回す
+    cls は __init__ と同じ引数を受け取る reset() を持つこと
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.free = []
+        self.created = 0
+        self.reused = 0
+        self.in_use = 0
+        self.peak = 0
+
+    def acquire(self, *args, **kwargs):
+        if self.free:
+            obj = self.free.pop()
+            obj.reset(*args, **kwargs)
+            self.reused += 1
+        else:
+            obj = self.cls(*args, **kwargs)
+            self.created += 1
+        self.in_use += 1
+        if self.in_use > self.peak:
+            self.peak = self.in_use
+        return obj
+
+    def release(self, obj):
+        self.in_use -= 1
+        self.free.append(obj)
+
+    def release_all(self, objs):
+        for obj in objs:
+            self.release(obj)
+
+    def stats(self):
+        return {"created": self.created, "reused": self.reused, "in_use": self.in_use,
+                "free": len(self.free), "peak": self.peak}
+
+
+def seconds_to_ticks(seconds):
+    """秒を SIM_HZ の tick 数にする（1tick より短くはしない）"""
+    return max(1, round(seconds * SIM_HZ))
+
+
+# TimerWheel に登録した1件。deadline: 発火する時刻（tick）、seq: 登録順の番号（タイマーの id）
+Timer = namedtuple("Timer", ["deadline", "seq", "name", "args"])
+
+
+class TimerWheel:
+    """
+    シミュレーションの tick を時計にしたタイマー（階層化したタイマーホイール）
+    発火したものはコールバックではなく (名前, 引数) のイベントとして返すので、
+    登録中のタイマーをそのまま保存・復元でき、リプレイでも同じ tick に発火する
+    段 L の枠は 256^L tick 分。遠いタイマーは上の段に入れておき、その枠の番が来たら下の段へ移す
+    登録・取り消し・1tick進めるのはどれも O(1)（移し替えは1つのタイマーにつき段の数まで）
+    """
+    SLOT_BITS = 8
+    SLOTS = 1 << SLOT_BITS
+    LEVELS = 4  # 256^4 tick（60Hz で約2年）より先のものは overflow に入れる
+
+    def __init__(self):
+        self.wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self.overflow = []
+        self.used = set()  # (段, 枠) タイマーを入れたことのある枠。restore で空にするのはここだけ
+        self.now = 0
+        self.next_seq = 0
+        self.pending = {}  # seq -> Timer（発火も取り消しもしていないもの）
+
+    def __len__(self):
+        return len(self.pending)
+
+    def schedule(self, ticks, name, *args):
+        """ticks 後に name のイベントを起こす。戻り値はタイマーの id"""
+        timer = Timer(self.now + max(1, ticks), self.next_seq, name, args)
+        self.next_seq += 1
+        self.pending[timer.seq] = timer
+        self._place(timer)
+        return timer.seq
+
+    def _place(self, timer):
+        """発火までの tick 数に合った段の枠に入れる"""
+        delta = timer.deadline - self.now
+        for level, wheel in enumerate(self.wheels):
+            if delta < 1 << (self.SLOT_BITS * (level + 1)):
+                index = (timer.deadline >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+                wheel[index].append(timer)
+                self.used.add((level, index))
+                return
+        self.overflow.append(timer)
+
+    def cancel(self, seq):
+        """タイマーを取り消す（発火済み・取り消し済み・None なら何もしない）。枠からは移すときに捨てる"""
+        self.pending.pop(seq, None)
+
+    def cancel_named(self, *names):
+        """names のイベントを全て取り消す（ステージを切り替えるときなど。登録中の数に比例）"""
+        for seq in [seq for seq, timer in self.pending.items() if timer.name in names]:
+            del self.pending[seq]
+
+    def remaining(self, seq):
+        """発火までの tick 数（登録されていなければ 0）"""
+        timer = self.pending.get(seq)
+        return 0 if timer is None else timer.deadline - self.now
+
+    def advance(self):
+        """時刻を1tick進め、発火したイベント (名前, 引数) のリストを登録順に返す"""
+        self.now += 1
+        now = self.now
+        mask = self.SLOTS - 1
+        if not now & mask:
+            # 上の段の枠の境目。上の段から順に、番が来た枠のタイマーを下の段へ移す
+            for level in range(self.LEVELS, 0, -1):
+                shift = self.SLOT_BITS * level
+                if now & ((1 << shift) - 1):
+                    continue
+                if level == self.LEVELS:
+                    moving, self.overflow = self.overflow, []
+                else:
+                    wheel = self.wheels[level]
+                    index = (now >> shift) & mask
+                    moving, wheel[index] = wheel[index], []
+                for timer in moving:
+                    if self.pending.get(timer.seq) is timer:
+                        self._place(timer)
+        wheel = self.wheels[0]
+        slot, wheel[now & mask] = wheel[now & mask], []
+        due = []
+        for timer in slot:
+            if self.pending.get(timer.seq) is timer: # 取り消されたものは捨てる
+                del self.pending[timer.seq]
+                due.append(timer)
+        if len(due) > 1:
+            due.sort(key=lambda t: t.seq) # 移し替えで枠の中の順番が変わっても登録順に発火する
+        return [(timer.name, timer.args) for timer in due]
+
+    def state(self):
+        """(時刻, 次の id, 登録中のタイマー)。数値・文字列・タプルだけでできている"""
+        return self.now, self.next_seq, tuple(sorted(self.pending.values(), key=lambda t: t.seq))
+
+    def restore(self, state):
+        """state() の値に戻す。枠は作り直さず、使った枠だけをその場で空にする"""
+        now, next_seq, timers = state
+        wheels = self.wheels
+        for level, index in self.used:
+            wheels[level][index].clear()
+        self.used.clear()
+        self.overflow.clear()
+        self.pending.clear()
+        self.now = now
+        self.next_seq = next_seq
+        for deadline, seq, name, args in timers:
+            timer = Timer(deadline, seq, name, tuple(args))
+            self.pending[seq] = timer
+            self._place(timer)
+
+
+class TileMap:
+    """
+    地面と浮遊ブロックをセルごとに登録した格子
+    「この点に足場があるか」「この rect の近くの足場はどれか」を足場の数によらず調べられる
+    """
+    def __init__(self, rects, cell_size=100):
+        self.rects = list(rects)
+        self.cell_size = cell_size
+        cells = {}
+        for i, r in enumerate(self.rects):
+            xs, ys = self._cell_range(r)
+            for cx in xs:
+                for cy in ys:
+                    cells.setdefault((cx, cy), []).append(i)
+        self.cells = {key: tuple(v) for key, v in cells.items()}
+
+    def _cell_range(self, rect):
+        cs = self.cell_size
+        return (range(rect.left // cs, (rect.right - 1) // cs + 1),
+                range(rect.top // cs, (rect.bottom - 1) // cs + 1))
+
+    def solid_at(self, x, y):
+        """点 (x, y) が足場の中にあるか"""
+        cs = self.cell_size
+        for i in self.cells.get((int(x) // cs, int(y) // cs), ()):
+            if self.rects[i].collidepoint(x, y):
+                return True
+        return False
+
+    def candidates(self, rect, margin=0):
+        """rect（を margin だけ広げた範囲）と同じセルにある足場。元の並び順で返す"""
+        cs = self.cell_size
+        cells = self.cells
+        ys = range((rect.top - margin) // cs, (rect.bottom - 1 + margin) // cs + 1)
+        found = set()
+        for cx in range((rect.left - margin) // cs, (rect.right - 1 + margin) // cs + 1):
+            for cy in ys:
+                idx = cells.get((cx, cy))
+                if idx:
+                    found.update(idx)
+        if not found:
+            return []
+        rects = self.rects
+        return [rects[i] for i in sorted(found)]
+
+
+class SpatialHash:
+    """
+    一様グリッドで近くのオブジェクトだけを取り出す当たり判定の下準備（ブロードフェーズ）
+    毎tick clear() して insert() し直す。query() の結果は登録した順に並ぶ
+    """
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        self.cells = {}
+        self._order = {}
+
+    def clear(self):
+        self.cells.clear()
+        self._order.clear()
+
+    def _cell_range(self, rect):
+        cs = self.cell_size
+        return (range(rect.left // cs, (rect.right - 1) // cs + 1),
+                range(rect.top // cs, (rect.bottom - 1) // cs + 1))
+
+    def insert(self, obj, rect=None):
+        rect = obj.rect if rect is None else rect
+        self._order[id(obj)] = len(self._order)
+        xs, ys = self._cell_range(rect)
+        for cx in xs:
+            for cy in ys:
+                self.cells.setdefault((cx, cy), []).append(obj)
+
+    def query(self, rect):
+        """rect と同じセルにいるオブジェクト（重なっているとは限らない）"""
+        found = {}
+        xs, ys = self._cell_range(rect)
+        for cx in xs:
+            for cy in ys:
+                for obj in self.cells.get((cx, cy), ()):
+                    found[id(obj)] = obj
+        if len(found) < 2:
+            return list(found.values())
+        return sorted(found.values(), key=lambda o: self._order[id(o)])
+
+
+# 衝突の記録。kind: "projectile", "player_enemy", "player_falling", "player_item"
+CollisionEvent = namedtuple("CollisionEvent", ["kind", "a", "b"])
+
+
+class HazardStore:
+    """
+    Enemy と FallingEnemy の位置・速度・大きさを numpy 配列で持ち、まとめて更新する（要 numpy）
+    移動、崖と壁での反転、rect との重なり判定を配列演算で行う
+    エンティティの rect へは sync() したときだけ書き戻す
+    並び順は enemies → falling_enemies（元のリストの順）
+    """
+    WALKER = 0
+    FALLING = 1
+
+    def __init__(self, enemies, falling_enemies, platform_rects):
+        if np is None:
+            raise RuntimeError("HazardStore を使うには numpy が必要です")
+        self.objects = list(enemies) + list(falling_enemies)
+        rects = [o.rect for o in self.objects]
+        self.x = np.array([r.x for r in rects], dtype=np.int32)
+        self.y = np.array([r.y for r in rects], dtype=np.int32)
+        self.w = np.array([r.width for r in rects], dtype=np.int32)
+        self.h = np.array([r.height for r in rects], dtype=np.int32)
+        self.vx = np.array([getattr(o, "vx", 0) for o in self.objects], dtype=np.int32)
+        self.vy = np.array([getattr(o, "vy", 0) if isinstance(o, FallingEnemy) else 0
+                            for o in self.objects], dtype=np.int32)
+        self.kind = np.array([self.WALKER] * len(enemies) + [self.FALLING] * len(falling_enemies),
+                             dtype=np.int8)
+        # 地上の敵が折り返す左右の端（Enemy.left_bound / right_bound）
+        self.lo = np.array([getattr(o, "left_bound", None) or 0 for o in self.objects], dtype=np.int32)
+        self.hi = np.array([getattr(o, "right_bound", None) or WIDTH for o in self.objects], dtype=np.int32)
+        self.prev_x = self.x.copy()
+        self.prev_y = self.y.copy()
+        # 足場 (P個) の left, top, right, bottom
+        self.pl = np.array([r.left for r in platform_rects], dtype=np.int32)
+        self.pt = np.array([r.top for r in platform_rects], dtype=np.int32)
+        self.pr = np.array([r.right for r in platform_rects], dtype=np.int32)
+        self.pb = np.array([r.bottom for r in platform_rects], dtype=np.int32)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def step(self):
+        """Enemy.update / FallingEnemy.update をまとめて行う"""
+        x, y, w, h, vx = self.x, self.y, self.w, self.h, self.vx
+        self.prev_x[:] = x
+        self.prev_y[:] = y
+        walker = self.kind == self.WALKER
+        falling = ~walker
+
+        # 落ちてくる敵: 下に落ちる（画面の下に出たものは fallen() で World が取り除く）
+        y[falling] += self.vy[falling]
+
+        # 地上の敵: 水平移動
+        x[walker] += vx[walker]
+        right = x + w
+        bottom = y + h
+        # 進行方向の足元に地面があるか (N x P)
+        px = np.where(vx > 0, right, x)[:, None]
+        py = (bottom + 1)[:, None]
+        on_ground = ((self.pl <= px) & (px < self.pr) & (self.pt <= py) & (py < self.pb)).any(axis=1)
+        # 壁との衝突（上に乗っているだけの場合は無視）
+        overlap = ((x[:, None] < self.pr) & (right[:, None] > self.pl)
+                   & (y[:, None] < self.pb) & (bottom[:, None] > self.pt))
+        moving_right = (vx > 0)[:, None]
+        hit_right = overlap & moving_right & (x[:, None] < self.pl)
+        hit_left = overlap & ~moving_right & (right[:, None] > self.pr)
+        wall_r = walker & hit_right.any(axis=1)
+        wall_l = walker & hit_left.any(axis=1)
+        if wall_r.any():
+            nearest = np.where(hit_right, self.pl, np.iinfo(np.int32).max).min(axis=1)
+            x[wall_r] = nearest[wall_r] - w[wall_r]
+        if wall_l.any():
+            nearest = np.where(hit_left, self.pr, np.iinfo(np.int32).min).max(axis=1)
+            x[wall_l] = nearest[wall_l]
+        # 崖っぷちまたは壁に衝突したまたは画面外の場合は反転
+        turn = walker & (~on_ground | wall_r | wall_l | (x < self.lo) | (x + w > self.hi))
+        vx[turn] *= -1
+
+    def overlaps(self, rect):
+        """rect と重なっている敵の添字（並び順どおり）"""
+        hit = ((self.x < rect.right) & (self.x + self.w > rect.left)
+               & (self.y < rect.bottom) & (self.y + self.h > rect.top))
+        return np.flatnonzero(hit)
+
+    def sync_index(self, i):
+        """i番目の敵の rect と速度を配列の値に合わせる"""
+        obj = self.objects[i]
+        obj.rect.topleft = (int(self.x[i]), int(self.y[i]))
+        obj.prev_pos = (int(self.prev_x[i]), int(self.prev_y[i]))
+        if self.kind[i] == self.WALKER:
+            obj.vx = int(self.vx[i])
+        return obj
+
+    def sync(self):
+        """全ての敵の rect を配列の値に合わせる（描画の前に呼ぶ）"""
+        for i in range(len(self.objects)):
+            self.sync_index(i)
+
+    def fallen(self):
+        """画面の下まで落ちた、落ちてくる敵（並び順どおり）"""
+        gone = np.flatnonzero((self.kind == self.FALLING) & (self.y > HEIGHT))
+        return [self.objects[i] for i in gone]
+
+    def insert(self, index, obj):
+        """落ちてくる敵を index 番目に加える（タイマーで出し直したとき）"""
+        r = obj.rect
+        self.objects.insert(index, obj)
+        for name, value in (("x", r.x), ("y", r.y), ("w", r.width), ("h", r.height), ("vx", 0),
+                            ("vy", obj.vy), ("kind", self.FALLING), ("lo", 0), ("hi", WIDTH),
+                            ("prev_x", r.x), ("prev_y", r.y)):
+            setattr(self, name, np.insert(getattr(self, name), index, value))
+
+    def discard(self, removed_ids):
+        """倒された敵（id の集合）を配列から取り除く"""
+        keep = np.array([id(o) not in removed_ids for o in self.objects], dtype=bool)
+        if keep.all():
+            return
+        self.objects = [o for o, k in zip(self.objects, keep) if k]
+        for name in ("x", "y", "w", "h", "vx", "vy", "kind", "lo", "hi", "prev_x", "prev_y"):
+            setattr(self, name, getattr(self, name)[keep])
+
+
+class NullProfiler:
+    """計測しないときのプロファイラ。どのメソッドも何もしない"""
+    enabled = False
+
+    def begin(self, name):
+        pass
+
+    def end(self):
+        pass
+
+    def end_frame(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class FrameProfiler:
+    """
+    メインループの処理ごと（入力・更新・当たり判定・描画・画面転送など）の時間を計る
+    begin(name) / end() で区間を囲み、フレームの終わりに end_frame() を呼ぶ
+    直近 window フレームの平均と p95、フレーム時間のヒストグラムを出せるほか、
+    Chrome のトレース形式 (chrome://tracing, Perfetto) の JSON に書き出せる
+    """
+    enabled = True
+    HISTOGRAM_EDGES_MS = (4, 8, 12, 16.7, 20, 25, 33.3, 50)
+
+    def __init__(self, window=300, trace_limit=200000):
+        self.window = window
+        self.samples = {}  # 区間名 -> 直近のフレームごとの合計時間 (ns) の deque
+        self.frame_times = deque(maxlen=window)
+        self.trace = deque(maxlen=trace_limit)  # (区間名, 開始 ns, 長さ ns)
+        self._stack = []
+        self._current = {}
+        self._origin = time.perf_counter_ns()
+        self._frame_start = self._origin
+
+    def begin(self, name):
+        self._stack.append((name, time.perf_counter_ns()))
+
+    def end(self):
+        name, start = self._stack.pop()
+        now = time.perf_counter_ns()
+        self._current[name] = self._current.get(name, 0) + now - start
+        self.trace.append((name, start, now - start))
+
+    def end_frame(self):
+        now = time.perf_counter_ns()
+        self.frame_times.append(now - self._frame_start)
+        self.trace.append(("frame", self._frame_start, now - self._frame_start))
+        self._frame_start = now
+        for name in self._current.keys() - self.samples.keys():
+            self.samples[name] = deque(maxlen=self.window)
+        for name, values in self.samples.items():
+            values.append(self._current.get(name, 0))
+        self._current = {}
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return 0.0, 0.0
+        ordered = sorted(values)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return sum(values) / len(values) / 1e6, p95 / 1e6
+
+    def stats(self):
+        """区間名 -> (平均 ms, p95 ms)。"frame" はフレーム全体"""
+        result = {name: self._summary(values) for name, values in self.samples.items()}
+        result["frame"] = self._summary(self.frame_times)
+        return result
+
+    def histogram(self):
+        """HISTOGRAM_EDGES_MS で区切ったフレーム時間の度数（最後は上限より長いもの）"""
+        counts = [0] * (len(self.HISTOGRAM_EDGES_MS) + 1)
+        for ns in self.frame_times:
+            ms = ns / 1e6
+            for i, edge in enumerate(self.HISTOGRAM_EDGES_MS):
+                if ms < edge:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        return counts
+
+    def draw_overlay(self, surf, x=10, y=190):
+        """半透明のパネルに平均・p95・ヒストグラムを描く"""
+        stats = self.stats()
+        lines = [("phase (ms)", "avg", "p95")]
+        for name, (avg, p95) in sorted(stats.items(), key=lambda kv: -kv[1][0]):
+            lines.append((name, f"{avg:.2f}", f"{p95:.2f}"))
+        font = get_font(20)
+        line_h = font.get_linesize()
+        hist = self.histogram()
+        panel = pg.Surface((260, line_h * len(lines) + 70), pg.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        for i, (name, avg, p95) in enumerate(lines):
+            ty = 4 + i * line_h
+            panel.blit(font.render(name, True, WHITE), (8, ty))
+            # 数値は右揃え
+            for text, right in ((avg, 180), (p95, 250)):
+                img = font.render(text, True, WHITE)
+                panel.blit(img, img.get_rect(topright=(right, ty)))
+        # ヒストグラム
+        top = 8 + line_h * len(lines)
+        peak = max(hist) or 1
+        bar_w = 240 // len(hist)
+        for i, count in enumerate(hist):
+            h = int(50 * count / peak)
+            color = (80, 220, 80) if i < 4 else (240, 80, 80)
+            pg.draw.rect(panel, color, (8 + i * bar_w, top + 50 - h, bar_w - 2, h))
+        return surf.blit(panel, (x, y))
+
+    def export_chrome_trace(self, path):
+        """Chrome のトレース形式で書き出す（時間はマイクロ秒）"""
+        events = [{"name": name, "ph": "X", "pid": 1, "tid": 1,
+                   "ts": (start - self._origin) / 1000, "dur": dur / 1000}
+                  for name, start, dur in self.trace]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# 1tick分の入力。キーボードの状態から作るほか、リプレイや自動テストから直接与えられる
+# checkpoint: ゲームオーバーのときに最後のチェックポイントから再開する
+InputState = namedtuple("InputState", ["left", "right", "jump", "fire", "retry", "quit", "checkpoint"],
+                        defaults=[False] * 7)
+
+
+def input_from_keys(keys, fire=False):
+    """pg.key.get_pressed() の結果を InputState に変換する"""
+    return InputState(left=bool(keys[pg.K_LEFT] or keys[pg.K_a]),
+                      right=bool(keys[pg.K_RIGHT] or keys[pg.K_d]),
+                      jump=bool(keys[pg.K_SPACE]),
+                      fire=fire,
+                      retry=bool(keys[pg.K_r]),
+                      quit=bool(keys[pg.K_ESCAPE]),
+                      checkpoint=bool(keys[pg.K_c]))
+
+
+# InputState の各項目を1バイトのビットに詰める（リプレイファイル用）
+_INPUT_TABLE = [InputState(*(bool(bits >> n & 1) for n in range(len(InputState._fields))))
+                for bits in range(1 << len(InputState._fields))]
+
+
+def pack_input(inp):
+    bits = 0
+    for n, pressed in enumerate(inp):
+        if pressed:
+            bits |= 1 << n
+    return bits
+
+
+def unpack_input(bits):
+    return _INPUT_TABLE[bits]
+
+
+REPLAY_MAGIC = b"NAR1"
+# マジック, seed, ステージ数, フラグ, tick数, 圧縮した入力の長さ
+REPLAY_HEADER = struct.Struct("<4sQHHII")
+REPLAY_FLAG_SCROLL = 1
+REPLAY_FLAG_ENDLESS = 2
+REPLAY_FLAG_PIXEL = 4
+
+
+class InputRecorder:
+    """1tickごとの入力を記録し、seed と最終状態と一緒にリプレイファイルに保存する"""
+    def __init__(self, world):
+        self.seed = world.seed
+        self.stage_num = world.stage_num
+        self.flags = world.mode_flags
+        self.inputs = bytearray()
+
+    def record(self, inp):
+        self.inputs.append(pack_input(inp))
+
+    def save(self, path, world):
+        data = zlib.compress(bytes(self.inputs), 9)
+        summary = json.dumps(world.summary()).encode()
+        with open(path, "wb") as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, self.seed, self.stage_num, self.flags,
+                                        len(self.inputs), len(data)))
+            f.write(data)
+            f.write(summary)
+
+
+class Replay:
+    """
+    リプレイファイルの中身
+    run_headless() で画面なしに最速で再実行し、最終状態とクリアタイムを検証する
+    """
+    def __init__(self, seed, stage_num, inputs, summary, flags=0):
+        self.seed = seed
+        self.stage_num = stage_num
+        self.flags = flags
+        self.inputs = inputs
+        self.summary = summary
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            blob = f.read()
+        if blob[:4] != REPLAY_MAGIC:
+            raise ValueError(f"{path}: リプレイファイルではありません")
+        magic, seed, stage_num, flags, ticks, size = REPLAY_HEADER.unpack_from(blob)
+        start = REPLAY_HEADER.size
+        inputs = zlib.decompress(blob[start:start + size])
+        if len(inputs) != ticks:
+            raise ValueError(f"{path}: 入力の長さが記録と違います")
+        summary = json.loads(blob[start + size:])
+        return cls(seed, stage_num, inputs, summary, flags)
+
+    def new_world(self, **kwargs):
+        return World(seed=self.seed, stage_num=self.stage_num,
+                     scroll=bool(self.flags & REPLAY_FLAG_SCROLL),
+                     endless=bool(self.flags & REPLAY_FLAG_ENDLESS),
+                     pixel_collisions=bool(self.flags & REPLAY_FLAG_PIXEL), **kwargs)
+
+    def input_states(self):
+        return (_INPUT_TABLE[bits] for bits in self.inputs)
+
+    def run_headless(self, **world_kwargs):
+        """
+        全ての入力を流し込む
+        戻り値: (最終状態が記録と一致したか, World, 秒あたりのtick数)
+        """
+        world = self.new_world(**world_kwargs)
+        start = time.perf_counter()
+        for inp in self.input_states():
+            world.step(inp)
+        elapsed = time.perf_counter() - start
+        tps = len(self.inputs) / elapsed if elapsed > 0 else float("inf")
+        return world.summary() == self.summary, world, tps
+
+
+# World.save_state() の戻り値。画像やオブジェクトを含まず、数値・文字列・タプルだけでできている
+# stage: スクロールしないときの (ステージの添字, seed)
+# level: スクロールするときの (並び, カメラの x, 地形を生成済みのチャンク数)。並びは EndlessPlan なら seed
+# rng: World.rng を seed から使った数（CountingRandom.draws）
+# chunks: ステージ（スクロールするときは構築済みのチャンク）ごとの
+#         (番号, ハテナブロックの乱数を使った数, 使用済みか, 敵, 落ちてくる敵)
+# checkpoint: その時点で最後に通ったチェックポイントの GameState（その checkpoint は None）
+# timers: TimerWheel.state()
+GameState = namedtuple("GameState", ["seed", "stage_num", "flags", "tick", "state", "stage_index",
+                                     "stage_index_count", "play_time", "rng", "timers", "player",
+                                     "projectiles", "items", "next_stage", "stage", "level", "chunks",
+                                     "checkpoint"])
+
+
+def _chunk_state(number, hatena_blocks, enemies, falling_enemies):
+    # ハテナブロックは同じステージの乱数を共有している。全て使用済みなら乱数はもう使わない
+    draws = None
+    if any(not b.used for b in hatena_blocks):
+        draws = hatena_blocks[0].rng.draws
+    return (number, draws, tuple(b.used for b in hatena_blocks),
+            tuple(e.state() for e in enemies), tuple(fe.state() for fe in falling_enemies))
+
+
+def _restore_chunk(chunk_state, hatena_blocks):
+    """_chunk_state の結果をハテナブロックに戻し、(敵, 落ちてくる敵) のリストを作る"""
+    number, draws, used, enemies, falling_enemies = chunk_state
+    if draws is not None:
+        hatena_blocks[0].rng.rewind(draws) # ステージを構築したときの乱数（seed は同じ）
+    for b, u in zip(hatena_blocks, used):
+        b.used = u
+    return [Enemy.from_state(e) for e in enemies], [FallingEnemy(*fe) for fe in falling_enemies]
+
+
+def _plan_state(plan):
+    return plan.seed if isinstance(plan, EndlessPlan) else tuple(tuple(p) for p in plan)
+
+
+SAVE_MAGIC = b"NAV1"
+
+
+def dump_state(state):
+    """GameState をセーブファイルの中身（バイト列）にする"""
+    return SAVE_MAGIC + zlib.compress(json.dumps(state, separators=(",", ":")).encode(), 9)
+
+
+def load_state(blob):
+    if blob[:4] != SAVE_MAGIC:
+        raise ValueError("セーブデータではありません")
+    state = GameState(*json.loads(zlib.decompress(blob[4:])))
+    if state.checkpoint is not None:
+        state = state._replace(checkpoint=GameState(*state.checkpoint))
+    return state
+
+
+def save_game(path, world):
+    with open(path, "wb") as f:
+        f.write(dump_state(world.save_state()))
+
+
+def load_game(path):
+    with open(path, "rb") as f:
+        return load_state(f.read())
+
+
+class World:
+    """
+    描画や画面に依存しないゲーム本体
+    step() に InputState を渡すと1tick分だけゲームが進む
+    state: "start", "play", "gameover", "goal" のいずれか
+    """
+    def __init__(self, seed=None, stage_num=5, vectorized=False, prefetch=False, scroll=False,
+                 endless=False, pixel_collisions=False):
+        """
+        vectorized: True なら敵の更新と当たり判定を HazardStore でまとめて行う（要 numpy）
+        prefetch: True なら次のステージをバックグラウンドで構築しておく
+        scroll: True ならステージを横に並べた1本の長いステージをカメラでスクロールする
+        endless: True なら自動生成したステージがどこまでも続く（scroll を含む、ゴールなし）
+        pixel_collisions: True なら敵との当たり判定を rect が重なった後に画像のマスクで確かめる
+        """
+        if seed is None:
+            seed = random.getrandbits(63)
+        self.seed = seed  # リプレイで同じ展開を再現するために記録する
+        self.rng = CountingRandom(seed)
+        self.tick = 0
+        self.stage_num = stage_num
+        self.vectorized = vectorized
+        self.scroll = scroll or endless
+        self.endless = endless
+        self.pixel_collisions = pixel_collisions
+        self.hazards = None
+        self.level = None   # スクロールするときの ChunkedLevel
+        self.camera = None  # スクロールするときの Camera
+        self.prefetcher = StagePrefetcher() if prefetch else None
+        self.profiler = NULL_PROFILER
+        # 弾・アイテムは使い回す（敵はステージやチャンクと一緒に作って捨てる）
+        self.projectile_pool = ObjectPool(Projectile)
+        self.item_pool = ObjectPool(Item)
+        self.projectiles = []
+        self.items = []
+        self.next_stage = None  # 次に読み込むステージの (添字, seed)
+        self.goal_stage_index = len(STAGE_BUILDERS) - 1
+        self.running = True
+        self.broadphase = SpatialHash()
+        self.stage_version = 0  # ステージを読み込むたびに増える（描画キャッシュの判定用）
+        self.stage_key = None  # スクロールしないときの今のステージの (添字, seed)
+        self.checkpoint = None  # 最後に通ったチェックポイントの GameState
+        # TimerWheel のイベントの名前ごとの処理
+        self.timer_handlers = {"power_end": self._on_power_end, "invul_end": self._on_invul_end,
+                               "reveal_item": self._on_reveal_item, "respawn_falling": self._on_respawn_falling}
+        self.reset()
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        """GameState と同じ設定の World を作り、その状態にする"""
+        world = cls(seed=state.seed, stage_num=state.stage_num,
+                    scroll=bool(state.flags & REPLAY_FLAG_SCROLL),
+                    endless=bool(state.flags & REPLAY_FLAG_ENDLESS),
+                    pixel_collisions=bool(state.flags & REPLAY_FLAG_PIXEL), **kwargs)
+        world.restore_state(state)
+        return world
+
+    def fork(self, **kwargs):
+        """今の状態から分かれた別の World（リプレイや自動テストで途中から別の入力を試す）"""
+        kwargs.setdefault("vectorized", self.vectorized)
+        return World.from_state(self.save_state(), **kwargs)
+
+    @property
+    def mode_flags(self):
+        """リプレイやセーブファイルに記録する設定（REPLAY_FLAG_*）"""
+        return ((REPLAY_FLAG_SCROLL if self.scroll else 0)
+                | (REPLAY_FLAG_ENDLESS if self.endless else 0)
+                | (REPLAY_FLAG_PIXEL if self.pixel_collisions else 0))
+
+    def reset(self):
+        """最初のステージからやり直す"""
+        # タイマーの時計はプレイ中の tick だけ進む
+        self.timers = TimerWheel()
+        # 画面の下に消えて、出し直すのを待っている落ちてくる敵。(x, 幅, 高さ, 速さ) -> インスタンスのリスト
+        self.fallen = {}
+        self.player = Player(50, HEIGHT - 90 - 50, self.timers)
+        self.stage_index = 0
+        self.stage_index_count = 0
+        self.play_time = 0.0
+        self.state = "start"
+        self.checkpoint = None
+        if self.scroll:
+            self.load_level()
+        else:
+            self.load_stage(0, self.rng.getrandbits(32))
+
+    def load_stage(self, stage_index, seed):
+        """ステージを読み込む（プレイヤーはそのまま）。先読み済みならそれに差し替えるだけ"""
+        # 前のステージの弾とアイテムをプールに戻し、まだ出ていないアイテムと敵は出さない
+        self.projectile_pool.release_all(self.projectiles)
+        self.item_pool.release_all(self.items)
+        self.timers.cancel_named(*STAGE_TIMER_EVENTS)
+        self.fallen.clear()
+        stage = None
+        if self.prefetcher is not None:
+            stage = self.prefetcher.take(stage_index, seed)
+        if stage is None:
+            stage = build_stage(stage_index, seed)
+        self._set_stage(stage, seed)
+        self.items = stage.items
+        self.projectiles = []
+        if self.vectorized:
+            self.hazards = HazardStore(self.enemies, self.falling_enemies, self.tiles.rects)
+        self._plan_next_stage()
+
+    def _set_stage(self, stage, seed):
+        """構築済みのステージの足場と敵を使う"""
+        self.stage_index = stage.index
+        self.stage_key = (stage.index, seed)
+        self.stage_version += 1
+        self.ground_platforms = stage.ground_platforms
+        self.floating_platforms = stage.floating_platforms
+        self.hatena_platforms = stage.hatena_platforms
+        self.goal_platforms = stage.goal_platforms
+        self.enemies = stage.enemies
+        self.falling_enemies = stage.falling_enemies
+        self.tiles = stage.tiles
+        self.platforms = self.ground_platforms + self.floating_platforms + self.goal_platforms
+        for b in self.hatena_platforms:
+            b.item_pool = self.item_pool
+            b.timers = self.timers
+
+    def load_level(self):
+        """
+        スクロールするステージを用意する
+        最初のステージ、ランダムな stage_num-1 個のステージ、ゴールステージを横に並べる
+        """
+        self.projectile_pool.release_all(self.projectiles)
+        self.item_pool.release_all(self.items)
+        self.projectiles = []
+        self.items = []
+        if self.endless:
+            plan = EndlessPlan(self.rng.getrandbits(32))
+        else:
+            plan = [(0, self.rng.getrandbits(32))]
+            for _ in range(self.stage_num - 1):
+                plan.append((self.rng.randint(0, self.goal_stage_index - 1), self.rng.getrandbits(32)))
+            plan.append((self.goal_stage_index, self.rng.getrandbits(32)))
+        self.level = ChunkedLevel(plan, prefetcher=self.prefetcher)
+        self.camera = Camera(self.level.width)
+        self.player.min_x = 0
+        self.next_stage = None
+        self.stage_index = 0
+        self.enemies = []
+        self.falling_enemies = []
+        self._stream_chunks()
+
+    def _stream_chunks(self):
+        """カメラの位置に合わせてチャンクを入れ替え、更新・当たり判定の対象を集め直す"""
+        if not self.level.stream(self.camera.x):
+            return
+        self.sync_hazards()
+        self._gather_chunks()
+        self._evict_items()
+
+    def _evict_items(self):
+        """捨てたチャンクに残っていたアイテムをプールに戻す（敵と同じく、後ろのものは持たない）"""
+        active = self.level.active()
+        if not active:
+            return
+        left = active[0].number * WIDTH
+        behind = {id(it) for it in self.items if it.rect.right <= left}
+        if behind:
+            self.items = self._release_removed(self.items, behind, self.item_pool)
+
+    def _gather_chunks(self):
+        """構築済みのチャンクから足場と敵のリストを作り直す"""
+        chunks = [c.stage for c in self.level.active()]
+        self.ground_platforms = [p for c in chunks for p in c.ground_platforms]
+        self.floating_platforms = [p for c in chunks for p in c.floating_platforms]
+        self.hatena_platforms = [b for c in chunks for b in c.hatena_platforms]
+        self.goal_platforms = [g for c in chunks for g in c.goal_platforms]
+        self.enemies = [e for c in chunks for e in c.enemies]
+        self.falling_enemies = [fe for c in chunks for fe in c.falling_enemies]
+        self.tiles = TileMap(self.ground_platforms + self.floating_platforms)
+        self.platforms = self.ground_platforms + self.floating_platforms + self.goal_platforms
+        self.stage_version += 1
+        for b in self.hatena_platforms:
+            b.item_pool = self.item_pool
+            b.timers = self.timers
+        if self.vectorized:
+            self.hazards = HazardStore(self.enemies, self.falling_enemies, self.tiles.rects)
+
+    def _scroll(self):
+        """カメラをプレイヤーに合わせて進め、チャンクを入れ替える"""
+        player = self.player
+        camera = self.camera
+        if camera.level_width is not None and player.rect.right > camera.level_width:
+            player.rect.right = camera.level_width
+        camera.follow(player.rect)
+        player.min_x = camera.x  # 画面の左端より後ろには戻れない
+        # 地形の生成は1tickに1チャンクまでにして、速く走ってもカクつかないようにする
+        self.level.generate_ahead(camera.x, budget=GENERATE_PER_TICK)
+        self._stream_chunks()
+        number = player.rect.centerx // WIDTH
+        self.stage_index = self.level.stage_index_at(player.rect.centerx)
+        count = number if self.endless else min(number, self.stage_num)
+        # 少し戻っても進んだ数は減らさない（チェックポイントも前にしか進まない）
+        entered = count > self.stage_index_count
+        self.stage_index_count = max(self.stage_index_count, count)
+        if entered and self.state == "play":
+            self._take_checkpoint() # 新しいステージに入った
+
+    def camera_offset(self, alpha=1.0):
+        """描画するときにずらす x（スクロールしないときは 0）"""
+        return 0 if self.camera is None else self.camera.offset(alpha)
+
+    def active_chunks(self):
+        """スクロールするときに構築済みのチャンク（左から順）"""
+        return self.level.active()
+
+    def _plan_next_stage(self):
+        """次のステージを今のうちに決めておき、先読みを頼む"""
+        if self.stage_index == self.goal_stage_index:
+            self.next_stage = None
+            return
+        # 5ステージクリアしたらゴールステージへ
+        if self.stage_index_count + 1 >= self.stage_num:
+            next_index = self.goal_stage_index
+        else:
+            # 次のランダムなステージへ（ゴールステージを除く）
+            next_index = self.rng.randint(0, self.goal_stage_index - 1)
+        self.next_stage = (next_index, self.rng.getrandbits(32))
+        if self.prefetcher is not None:
+            self.prefetcher.request(*self.next_stage)
+
+    def moving_objects(self):
+        """位置が tick ごとに変わるオブジェクト（描画の補間対象）"""
+        yield self.player
+        yield from self.enemies
+        yield from self.falling_enemies
+        yield from self.projectiles
+        yield from self.items
+
+    def _store_prev_positions(self):
+        if self.hazards is not None:
+            # 敵の前の位置は HazardStore が配列で持っている
+            objs = [self.player, *self.projectiles, *self.items]
+        else:
+            objs = self.moving_objects()
+        for obj in objs:
+            obj.prev_pos = obj.rect.topleft
+        if self.camera is not None:
+            self.camera.prev_x = self.camera.x
+
+    def sync_hazards(self):
+        """HazardStore を使っているとき、敵の rect を最新の位置にする（描画の前に呼ぶ）"""
+        if self.hazards is not None:
+            self.hazards.sync()
+
+    def save_state(self, checkpoint=True):
+        """
+        今のゲームの状態を GameState にする（画像は含まないので小さく、すぐに作れる）
+        restore_state() でこの時点に戻せる。dump_state() でファイルにも保存できる
+        checkpoint: False なら最後のチェックポイントを含めない（チェックポイント自身を作るとき）
+        """
+        self.sync_hazards()
+        if self.camera is None:
+            stage, level = self.stage_key, None
+            chunks = (_chunk_state(0, self.hatena_platforms, self.enemies, self.falling_enemies),)
+        else:
+            stage = None
+            level = (_plan_state(self.level.plan), self.camera.x, self.level.generated)
+            chunks = tuple(_chunk_state(c.number, c.stage.hatena_platforms, c.stage.enemies,
+                                        c.stage.falling_enemies) for c in self.level.active())
+        return GameState(self.seed, self.stage_num, self.mode_flags, self.tick, self.state,
+                         self.stage_index, self.stage_index_count, self.play_time, self.rng.draws,
+                         self.timers.state(), self.player.state(), tuple(p.state() for p in self.projectiles),
+                         tuple(it.state() for it in self.items), self.next_stage, stage, level, chunks,
+                         self.checkpoint if checkpoint else None)
+
+    def _run_timers(self):
+        """タイマーの時計を1tick進め、発火したイベントを処理する"""
+        for name, args in self.timers.advance():
+            self.timer_handlers[name](*args)
+
+    def _on_power_end(self):
+        self.player.clear_power()
+
+    def _on_invul_end(self):
+        self.player.invul_timer = None
+
+    def _on_reveal_item(self, x, y, kind):
+        if self.camera is not None and x // WIDTH not in self.level.chunks:
+            return # ブロックのあったチャンクはもう捨てた
+        self.items.append(self.item_pool.acquire(x, y, kind))
+
+    def _on_respawn_falling(self, x, w, h, speed):
+        # 消えたときのインスタンスを使い回す（保存した状態から戻したときは持っていないので作る）
+        key = (x, w, h, speed)
+        parked = self.fallen.get(key)
+        if parked:
+            fe = parked.pop()
+            if not parked:
+                del self.fallen[key]
+            fe.reset(x, -h, w, h, speed) # 画面の上から出てくる
+        else:
+            fe = FallingEnemy(x, -h, w, h, speed)
+        index = len(self.falling_enemies)
+        if self.camera is not None:
+            number = x // WIDTH
+            chunk = self.level.chunks.get(number)
+            if chunk is None:
+                return # 元のチャンクはもう捨てた
+            chunk.stage.falling_enemies.append(fe)
+            # チャンクの順に並べる（保存して戻したときと同じ順番で当たり判定する）
+            index = sum(len(c.stage.falling_enemies) for c in self.level.active() if c.number <= number) - 1
+        self.falling_enemies.insert(index, fe)
+        if self.hazards is not None:
+            self.hazards.insert(len(self.enemies) + index, fe)
+
+    def _drop_fallen(self):
+        """画面の下まで落ちた敵を取り除き、少し後に上から出し直すタイマーを登録する"""
+        if self.hazards is not None:
+            fallen = self.hazards.fallen()
+        else:
+            fallen = [fe for fe in self.falling_enemies if fe.rect.top > HEIGHT]
+        if not fallen:
+            return
+        ticks = seconds_to_ticks(FALLING_RESPAWN_TIME)
+        for fe in fallen:
+            args = (fe.rect.x, fe.rect.width, fe.rect.height, fe.vy)
+            self.timers.schedule(ticks, "respawn_falling", *args)
+            self.fallen.setdefault(args, []).append(fe)
+        self._discard_hazards({id(fe) for fe in fallen})
+
+    def _discard_hazards(self, removed):
+        """倒された・画面の下に消えた敵（id の集合）を全てのリストから取り除く"""
+        if self.hazards is not None:
+            self.hazards.discard(removed)
+        if self.level is not None:
+            self.level.discard(removed)
+        self.enemies = [e for e in self.enemies if id(e) not in removed]
+        self.falling_enemies = [fe for fe in self.falling_enemies if id(fe) not in removed]
+
+    def _take_checkpoint(self):
+        self.checkpoint = self.save_state(checkpoint=False)
+
+    def restore_state(self, state):
+        """
+        save_state() の時点に戻す
+        今と同じステージ（チャンク）なら足場は作り直さず、敵・アイテム・弾だけを入れ替える
+        """
+        mode = REPLAY_FLAG_SCROLL | REPLAY_FLAG_ENDLESS
+        if state.stage_num != self.stage_num or (state.flags & mode) != (self.mode_flags & mode):
+            raise ValueError("ステージ数やスクロールの設定が違う状態には戻せません")
+        self.tick = state.tick
+        self.state = state.state
+        self.play_time = state.play_time
+        self.checkpoint = state.checkpoint
+        self.seed = state.seed
+        self.rng.seed(state.seed)
+        self.rng.rewind(state.rng)
+        self.timers.restore(state.timers)
+        self.fallen.clear()
+        self.player = Player.from_state(state.player, self.timers)
+        self.projectile_pool.release_all(self.projectiles)
+        self.item_pool.release_all(self.items)
+        self.projectiles = [self.projectile_pool.acquire(*p) for p in state.projectiles]
+        self.items = [self.item_pool.acquire(*it) for it in state.items]
+        self.next_stage = tuple(state.next_stage) if state.next_stage else None
+        self.hazards = None
+        if self.camera is None:
+            key = tuple(state.stage)
+            if key != self.stage_key:
+                self._set_stage(build_stage(*key), key[1])
+            self.enemies, self.falling_enemies = _restore_chunk(state.chunks[0], self.hatena_platforms)
+            if self.vectorized:
+                self.hazards = HazardStore(self.enemies, self.falling_enemies, self.tiles.rects)
+            if self.prefetcher is not None and self.next_stage is not None:
+                self.prefetcher.request(*self.next_stage)
+        else:
+            plan, camera_x, generated = state.level
+            plan = plan if self.endless else tuple(tuple(p) for p in plan)
+            if plan != _plan_state(self.level.plan):
+                self.level = ChunkedLevel(EndlessPlan(plan) if self.endless else list(plan),
+                                          prefetcher=self.prefetcher)
+                self.camera = Camera(self.level.width)
+            chunks = {}
+            for chunk_state in state.chunks:
+                chunk = self.level.chunk(chunk_state[0])
+                enemies, falling_enemies = _restore_chunk(chunk_state, chunk.stage.hatena_platforms)
+                chunk.stage.enemies[:] = enemies
+                chunk.stage.falling_enemies[:] = falling_enemies
+                chunks[chunk.number] = chunk
+            self.level.chunks = chunks
+            self.level.generated = generated
+            self.camera.x = self.camera.prev_x = camera_x
+            self._gather_chunks()
+        self.stage_index = state.stage_index
+        self.stage_index_count = state.stage_index_count
+
+    def step(self, inp, dt=SIM_DT):
+        """
+        1tick分ゲームを進める
+        dt は常に SIM_DT を使う想定（描画のフレームレートに左右されない）
+        """
+        self.tick += 1
+        self._store_prev_positions()
+        if inp.quit and self.state in ("gameover", "goal"):
+            self.running = False
+        elif self.state == "start":
+            if inp.jump:
+                self.play_time = 0.0 #タイマーリセット
+                self.state = "play"
+                self._take_checkpoint()
+        elif self.state == "play":
+            self._step_play(inp, dt)
+        elif inp.checkpoint and self.state == "gameover" and self.checkpoint is not None:
+            checkpoint = self.checkpoint
+            self.restore_state(checkpoint)
+            self.checkpoint = checkpoint
+        elif inp.retry:
+            self.reset()
+
+    def summary(self):
+        """リプレイの検証に使う、最終状態の要約"""
+        return [self.state, self.stage_index, self.stage_index_count, round(self.play_time, 6),
+                self.player.rect.x, self.player.rect.y, self.tick]
+
+    def fire(self):
+        """プレイヤーが火または氷の力を持っている場合にのみ発射物を生成します"""
+        player = self.player
+        if player.power in ('fire', 'ice'):
+            px = player.rect.centerx + player.facing * (player.rect.width//2 + 5)
+            py = player.rect.centery
+            self.projectiles.append(self.projectile_pool.acquire(px, py, player.power, player.facing))
+
+    def collect_collisions(self):
+        """
+        このtickの衝突を CollisionEvent のリストにして返す
+        敵は SpatialHash に登録し、近くにいるものだけを調べる
+        並び順: 弾と敵 → プレイヤーと敵 → プレイヤーとアイテム（それぞれ元のリストの順）
+        """
+        if self.hazards is not None:
+            return self._collect_collisions_vectorized()
+        grid = self.broadphase
+        grid.clear()
+        for e in self.enemies:
+            grid.insert(e)
+        for fe in self.falling_enemies:
+            grid.insert(fe)
+        events = []
+        pixel = self.pixel_collisions
+        # 弾は最初に当たった敵1体だけを倒す（地上の敵を落ちてくる敵より優先）
+        for p in self.projectiles:
+            hits = [h for h in grid.query(p.rect)
+                    if p.rect.colliderect(h.rect) and (not pixel or sprites_overlap(p, h))]
+            if hits:
+                hit = min(hits, key=lambda h: isinstance(h, FallingEnemy))
+                events.append(CollisionEvent("projectile", p, hit))
+        player_rect = self.player.rect
+        hits = [h for h in grid.query(player_rect)
+                if player_rect.colliderect(h.rect) and (not pixel or sprites_overlap(self.player, h))]
+        hits.sort(key=lambda h: isinstance(h, FallingEnemy))
+        for h in hits:
+            kind = "player_falling" if isinstance(h, FallingEnemy) else "player_enemy"
+            events.append(CollisionEvent(kind, self.player, h))
+        for it in self.items:
+            if player_rect.colliderect(it.rect):
+                events.append(CollisionEvent("player_item", self.player, it))
+        return events
+
+    def _collect_collisions_vectorized(self):
+        """collect_collisions と同じ結果を HazardStore の配列演算で求める"""
+        store = self.hazards
+        pixel = self.pixel_collisions
+        events = []
+        for p in self.projectiles:
+            hits = store.overlaps(p.rect)
+            if pixel:
+                hits = [i for i in hits if sprites_overlap(p, store.sync_index(i))]
+            if len(hits):
+                # 地上の敵が先に並んでいるので、最初のものが優先される
+                events.append(CollisionEvent("projectile", p, store.sync_index(hits[0])))
+        for i in store.overlaps(self.player.rect):
+            hit = store.sync_index(i)
+            if pixel and not sprites_overlap(self.player, hit):
+                continue
+            kind = "player_falling" if store.kind[i] == HazardStore.FALLING else "player_enemy"
+            events.append(CollisionEvent(kind, self.player, hit))
+        player_rect = self.player.rect
+        for it in self.items:
+            if player_rect.colliderect(it.rect):
+                events.append(CollisionEvent("player_item", self.player, it))
+        return events
+
+    @staticmethod
+    def _release_removed(objs, removed, pool):
+        """removed に入っているものをプールに戻し、残りのリストを返す"""
+        kept = []
+        for obj in objs:
+            if id(obj) in removed:
+                pool.release(obj)
+            else:
+                kept.append(obj)
+        return kept
+
+    def _step_play(self, inp, dt):
+        player = self.player
+        projectiles = self.projectiles
+        self.play_time += dt #プレイ時間の加算
+
+        if inp.fire:
+            self.fire()
+        player.handle_input(inp)
+
+        # ゴールとの当たり判定を先に実行
+        for g in self.goal_platforms:
+            if player.rect.colliderect(g.rect):
+                self.state = "goal"
+                break # ゴールに到達したらループを抜ける
+
+        prof = self.profiler
+        prof.begin("player")
+        if self.state == "play": # ゴール状態でない場合のみ、プレイヤーや敵の更新を続ける
+            player.update(self.tiles, self.hatena_platforms, self.items)
+        self._run_timers()
+        prof.end()
+        prof.begin("enemies")
+        if self.hazards is not None:
+            self.hazards.step()
+        else:
+            for e in self.enemies:
+                e.update(self.tiles)
+            for fe in self.falling_enemies:
+                fe.update()
+        self._drop_fallen()
+        prof.end()
+        # 発射物を更新する（画面外に出たものは削除）
+        prof.begin("collisions")
+        alive = []
+        view_left = self.camera.x if self.camera is not None else 0
+        for p in projectiles:
+            p.update()
+            if p.rect.right < view_left or p.rect.left > view_left + WIDTH:
+                self.projectile_pool.release(p)
+            else:
+                alive.append(p)
+        self.projectiles = projectiles = alive
+
+        # 当たり判定をまとめて集めてから、順番に解決する
+        dead = False
+        removed = set()
+        for ev in self.collect_collisions():
+            if id(ev.a) in removed or id(ev.b) in removed:
+                continue # 同じtickで既に消えたものは無視する
+            if ev.kind == "projectile":
+                removed.add(id(ev.a))
+                removed.add(id(ev.b))
+            elif ev.kind == "player_item":
+                player.apply_power(ev.b.kind, duration=ev.b.duration)
+                removed.add(id(ev.b))
+            # 無敵（muteki）は触れると敵を倒す
+            elif player.power == 'muteki':
+                removed.add(id(ev.b))
+            # 敵を倒すのは踏みつけ（プレイヤーが下向きに当たったとき）のみ
+            elif player.vy > 0 and player.rect.bottom - ev.b.rect.top < 20:
+                removed.add(id(ev.b))
+                player.vy = -8
+            # 能力を失った直後（無敵時間）は、敵に触れても何も起きない
+            elif player.invul_timer is None:
+                if ev.kind == "player_enemy" and player.power in ('fire', 'ice','speed','jump'):
+                    player.clear_power()
+                    player.start_invul()
+                elif ev.kind == "player_falling" and player.power in ('fire', 'ice'):
+                    player.clear_power()
+                    player.start_invul()
+                else:
+                    dead = True
+        if removed:
+            self._discard_hazards(removed)
+            self.projectiles = self._release_removed(projectiles, removed, self.projectile_pool)
+            self.items = self._release_removed(self.items, removed, self.item_pool)
+        prof.end()
+        # ゴールとの当たり判定
+        for g in self.goal_platforms:
+            if player.rect.colliderect(g.rect):
+                self.state = "goal"
+        #　穴に落ちた時の処理
+        if player.rect.top > HEIGHT:
+            dead = True
+        if dead:
+            self.state = "gameover"
+
+        if self.camera is not None:
+            self._scroll()
+            return
+        # ステージ切り替え（ゴールステージでない場合のみ）
+        if player.rect.right > WIDTH and self.stage_index != self.goal_stage_index and self.state != "goal":
+            self.stage_index_count += 1
+            self.load_stage(*self.next_stage)
+            player.rect.left = 0  # プレイヤーを左端に配置
+            player.rect.bottom = ground_y - Player_base_height # Y座標も初期位置に戻す
+            player.prev_pos = player.rect.topleft # 画面の端から端へ補間しない
+            if self.state == "play":
+                self._take_checkpoint()
+
+
+class SpriteSnapshot(namedtuple("SpriteSnapshot", ["rect", "prev_pos", "sprite_key", "anchor", "power"],
+                                defaults=(None,))):
+    """
+    描画に必要なだけを写し取ったエンティティ（WorldSnapshot の中身）
+    anchor: 画像を rect のどこに合わせるか（"topleft" か "midbottom"）
+    power: プレイヤーのときだけ、今の能力
+    """
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, obj, anchor="topleft", **extra):
+        return cls(obj.rect.copy(), getattr(obj, "prev_pos", None), obj.sprite_key(), anchor, **extra)
+
+    def blit_args(self, alpha=1.0, offset_x=0):
+        image = ASSETS.get(*self.sprite_key)
+        pos = interpolated_pos(self, alpha, offset_x)
+        if self.anchor == "midbottom":
+            pos = midbottom_pos(image, self.rect, *pos)
+        return image, pos
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
+
+
+class BlockSnapshot(namedtuple("BlockSnapshot", ["rect", "used"])):
+    """ハテナブロックの写し"""
+    __slots__ = ()
+
+    def blit_args(self, alpha=1.0, offset_x=0):
+        image = ASSETS.get(HATENA_EMPTY_IMAGE if self.used else HATENA_IMAGE, (40, 40))
+        return image, (self.rect.x - offset_x, self.rect.y)
+
+    def draw(self, surf, alpha=1.0, offset_x=0):
+        return surf.blit(*self.blit_args(alpha, offset_x))
+
+
+class WorldSnapshot:
+    """
+    1tick分の World の状態のうち、描画に使うものだけを写し取ったもの（作った後は変えない）
+    描画の関数には World の代わりに渡せるので、シミュレーションを別のスレッドで進めながら描ける
+    地面などの足場のリストはステージを読み込むたびに作り直されるので、コピーせずに参照する
+    """
+    def __init__(self, world, timestamp=0.0):
+        world.sync_hazards()
+        self.timestamp = timestamp  # 写した時刻（描画の補間に使う）
+        self.tick = world.tick
+        self.state = world.state
+        self.play_time = world.play_time
+        self.stage_index_count = world.stage_index_count
+        self.stage_num = world.stage_num
+        self.endless = world.endless
+        self.stage_version = world.stage_version
+        player = world.player
+        self.player = SpriteSnapshot.of(player, "midbottom", power=player.power)
+        self.enemies = tuple(SpriteSnapshot.of(e, "midbottom") for e in world.enemies)
+        self.falling_enemies = tuple(SpriteSnapshot.of(fe) for fe in world.falling_enemies)
+        self.projectiles = tuple(SpriteSnapshot.of(p) for p in world.projectiles)
+        self.items = tuple(SpriteSnapshot.of(it) for it in world.items)
+        self.hatena_platforms = tuple(BlockSnapshot(b.rect, b.used) for b in world.hatena_platforms)
+        self.ground_platforms = world.ground_platforms
+        self.floating_platforms = world.floating_platforms
+        self.goal_platforms = world.goal_platforms
+        self.camera = None
+        self._chunks = ()
+        if world.camera is not None:
+            self.camera = Camera(world.camera.level_width)
+            self.camera.x = world.camera.x
+            self.camera.prev_x = world.camera.prev_x
+            self._chunks = tuple(world.active_chunks())
+
+    def sync_hazards(self):
+        pass
+
+    def camera_offset(self, alpha=1.0):
+        return 0 if self.camera is None else self.camera.offset(alpha)
+
+    def active_chunks(self):
+        return self._chunks
+
+
+class SimulationThread:
+    """
+    World を別のスレッドで SIM_HZ（× speed）の一定の間隔で進める
+    1tick進めるたびに WorldSnapshot を作り、2つのバッファの空いている方に入れてから入れ替える
+    描画側は latest() で最新の写しを受け取るので、描画や画面の転送が遅れても物理と入力の間隔は変わらない
+    """
+    def __init__(self, world, replay_inputs=None, recorder=None, speed=1.0):
+        self.world = world
+        self.replay_inputs = replay_inputs
+        self.recorder = recorder
+        self.interval = SIM_DT / speed
+        self._input = InputState()
+        self._fire_requests = 0
+        self._fire_handled = 0
+        self._calls = deque()  # 次のtickの前に World に対して行う処理（セーブなど）
+        self._last_input = None  # 最後のtickで使った入力
+        self._wake = threading.Event()  # メニュー画面で眠っているときに起こす
+        self._buffers = [WorldSnapshot(world, time.perf_counter()), None]
+        self._front = 0
+        self._lock = threading.Lock()
+        self._stop = False
+        self.late_ticks = 0  # 予定より MAX_FRAME_TIME 以上遅れて追いつくのをあきらめた回数
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop = True
+        self._wake.set()
+        self._thread.join()
+
+    @property
+    def alive(self):
+        return self._thread.is_alive()
+
+    def set_input(self, inp):
+        """描画側のスレッドから、今押されているキーを渡す"""
+        if inp != self._input:
+            self._input = inp
+            self._wake.set()
+
+    def fire(self):
+        """発射ボタンが押された（次のtickで1回だけ発射する）"""
+        self._fire_requests += 1
+        self._wake.set()
+
+    def call(self, fn):
+        """fn(world) をシミュレーションのスレッドで、tickとtickの間に行う"""
+        self._calls.append(fn)
+        self._wake.set()
+
+    def _can_idle(self):
+        """メニュー画面で、前のtickから入力が変わっていなければ次の入力まで眠ってよい"""
+        return (self.replay_inputs is None and self.world.state in MENU_STATES
+                and self._input == self._last_input and self._fire_handled == self._fire_requests
+                and not self._calls)
+
+    def latest(self):
+        """(最新の WorldSnapshot, 補間率 alpha)"""
+        with self._lock:
+            snap = self._buffers[self._front]
+        alpha = min(1.0, (time.perf_counter() - snap.timestamp) / self.interval)
+        return snap, alpha
+
+    def _next_input(self):
+        if self.replay_inputs is not None:
+            return next(self.replay_inputs, None)
+        inp = self._input
+        if self._fire_handled != self._fire_requests:
+            self._fire_handled = self._fire_requests
+            inp = inp._replace(fire=True)
+        return inp
+
+    def _publish(self):
+        back = 1 - self._front
+        self._buffers[back] = WorldSnapshot(self.world, time.perf_counter())
+        with self._lock:
+            self._front = back
+
+    def _run(self):
+        world = self.world
+        next_tick = time.perf_counter()
+        while world.running and not self._stop:
+            self._wake.clear()
+            if self._can_idle():
+                self._wake.wait(MENU_WAIT_MS / 1000)
+                next_tick = time.perf_counter()  # 眠っていた間のtickは追いかけない
+                continue
+            now = time.perf_counter()
+            if now < next_tick:
+                time.sleep(next_tick - now)
+                continue
+            if now - next_tick > MAX_FRAME_TIME:
+                next_tick = now  # 遅れすぎたときは追いかけない
+                self.late_ticks += 1
+            while self._calls:
+                self._calls.popleft()(world)
+            self._last_input = self._input
+            inp = self._next_input()
+            if inp is None: # リプレイの最後まで再生した
+                world.running = False
+                break
+            if self.recorder is not None:
+                self.recorder.record(inp)
+            world.step(inp)
+            self._publish()
+            next_tick += self.interval
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(size):
+    """サイズごとに1つだけフォントを作る"""
+    return pg.font.Font(None, size)
+
+
+@functools.lru_cache(maxsize=256)
+def render_text(text, size, color):
+    """描画済みの文字列をキャッシュする（返り値は共有されるので書き換えないこと）"""
+    return get_font(size).render(text, True, color)
+
+
+class GlyphAtlas:
+    """
+    1文字ずつ描画した画像を並べて文字列を作る
+    "Time: 12.34" のように毎フレーム変わる数字を、文字列ごとにラスタライズせずに描ける
+    """
+    def __init__(self, size, color):
+        self.font = get_font(size)
+        self.color = color
+        self.height = self.font.get_height()
+        self.glyphs = {}
+
+    def glyph(self, ch):
+        img = self.glyphs.get(ch)
+        if img is None:
+            img = self.glyphs[ch] = self.font.render(ch, True, self.color)
+        return img
+
+    def draw(self, surf, text, x, y, center=True):
+        glyphs = [self.glyph(ch) for ch in text]
+        width = sum(g.get_width() for g in glyphs)
+        rect = pg.Rect(0, 0, width, self.height)
+        if center:
+            rect.center = (x, y)
+        else:
+            rect.topleft = (x, y)
+        seq = []
+        gx = rect.x
+        for g in glyphs:
+            seq.append((g, (gx, rect.y)))
+            gx += g.get_width()
+        surf.blits(seq, doreturn=False)
+        return rect
+
+
+@functools.lru_cache(maxsize=None)
+def get_atlas(size, color):
+    return GlyphAtlas(size, color)
+
 
 def draw_text(surf, text, size, x, y, color=BLACK, center=True):
     """画面にテキストを描画する関数"""
-    font = pg.font.Font(None, size)
-    txt = font.render(text, True, color)
+    txt = render_text(text, size, color)
     rect = txt.get_rect()
     if center:
         rect.center = (x, y)
     else:
         rect.topleft = (x, y)
-    surf.blit(txt, rect)
+    return surf.blit(txt, rect)
 
-def main():
-    pg.init()
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
-    pg.display.set_caption("北極探検ゲーム")
-    clock = pg.time.Clock()
-
-        #背景画像を読み込む
-    bg_img = pg.transform.scale(pg.image.load("img/haikei.png").convert(), (WIDTH, HEIGHT))
-        #地面用の画像を読み込む
-    ground_img = pg.image.load("img/ground.png").convert_alpha()
-        # 浮遊ブロック用の画像 (icy_block.png)
-    block_img = pg.image.load("img/huyuu.png").convert_alpha()
-
-    def init_game(stage_index=0): # 修正: init_game の実装を修正
-        player = Player(50, HEIGHT - 90 - 50)
-        builder = STAGE_BUILDERS[stage_index]
-        # ステージを構築
-        ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, items, falling_enemies = builder()
-        platforms = ground_platforms + floating_platforms + goal_platforms
-        projectiles = []
-        return player, platforms, ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, falling_enemies, items, projectiles
-
-    stage_index = 0
-    stage_index_count = 0
-    stage_num = 5
-    player, platforms, ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, falling_enemies, items, projectiles = init_game(stage_index)
-    power_display = PowerUpDisplay(pos=(WIDTH - 80, 20))
-    play_time = 0.0
-    state = "start"
-    running = True
-    while running:
-        # ... (イベント処理、更新処理は省略) ...
-        dt = clock.tick(FPS) / 1000.0 
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
-                running = False
-            if state == "play":
-                if event.type == pg.KEYDOWN and event.key == pg.K_x: #xが押されたときに球を発射
-                    # プレイヤーが火または氷の力を持っている場合にのみ発射物を生成します
-                    if player.power in ('fire', 'ice'):
-                        px = player.rect.centerx + player.facing * (player.rect.width//2 + 5)
-                        py = player.rect.centery
-                        projectiles.append(Projectile(px, py, player.power, player.facing))
+class RenderQueue:
+    """
+    描画する (画像, 位置) をレイヤーごとに集め、flush() でまとめて Surface.blits() に渡す
+    同じレイヤーの中は画像ごとに並べ替えてから描く（同じ画像を続けて転送する）
+    レイヤーは番号の小さい順に描くので、番号が大きいものほど手前になる
+    """
+    def __init__(self):
+        self.layers = {}
 
-        keys = pg.key.get_pressed()
+    def add(self, layer, image, pos):
+        self.layers.setdefault(layer, []).append((image, pos))
 
-        # スタート画面
-        if state == "start":
-            screen.blit(bg_img, (0, 0))
-            #パワーアップアイテムを適当に表示
-            power_display.draw(screen, player.power)
-
-            draw_text(screen, "GAME START", 100, WIDTH // 2, HEIGHT // 3, WHITE)
-            draw_text(screen, "SPACE : Start", 80, WIDTH // 2, HEIGHT // 2)
-            draw_text(screen, "< >: Move    SPACE : Jump", 80, WIDTH // 2, HEIGHT // 2 + 60, BLACK)
-            pg.display.flip()
-            if keys[pg.K_SPACE]:
-                play_time = 0.0 #タイマーリセット
-                state = "play"
-            continue
+    def add_sprite(self, layer, obj, alpha=1.0, offset_x=0):
+        """blit_args() を持つオブジェクトを加える"""
+        self.layers.setdefault(layer, []).append(obj.blit_args(alpha, offset_x))
 
-        # ゲームプレイ中
-        elif state == "play":
-            play_time += dt #プレイ時間の加算
+    def __len__(self):
+        return sum(len(seq) for seq in self.layers.values())
 
-            player.handle_input(keys)
+    def flush(self, surf, doreturn=True):
+        """全て描いて空にする。doreturn なら描いた領域の rect のリストを返す"""
+        rects = []
+        for layer in sorted(self.layers):
+            seq = self.layers[layer]
+            seq.sort(key=lambda blit: id(blit[0]))
+            if doreturn:
+                rects += surf.blits(seq)
+            else:
+                surf.blits(seq, doreturn=False)
+        self.layers.clear()
+        return rects
 
-            # ゴールとの当たり判定を先に実行
-            for g in goal_platforms:
-                if player.rect.colliderect(g.rect):
-                    state = "goal"
-                    break # ゴールに到達したらループを抜ける
 
-            if state == "play": # ゴール状態でない場合のみ、プレイヤーや敵の更新を続ける
-                player.update(platforms, hatena_platforms, items) # blocksとitemsをキーワード引数で渡す
-            player.update_power(dt)
-            for e in enemies:
-                e.update(platforms)
-            for fe in falling_enemies:
-                fe.update()
-            # 発射物を更新する
-            for p in projectiles[:]:
-                p.update()
-                # 画面外の場合は削除
-                if p.rect.right < 0 or p.rect.left > WIDTH:
-                    projectiles.remove(p)
-                    continue
-                for e in enemies[:]:
-                    if p.rect.colliderect(e.rect):
-                        enemies.remove(e)
-                        projectiles.remove(p)
-                        break
-                for fe in falling_enemies:
-                    if p.rect.colliderect(fe.rect):
-                        falling_enemies.remove(fe)
-                        projectiles.remove(p)
-                        break
-            # 敵との衝突
-            dead = False
-            for e in enemies[:]:
-                if player.rect.colliderect(e.rect):
-                    # 無敵（muteki）は触れると敵を倒す
-                    if player.power == 'muteki':
-                        enemies.remove(e)
-                    # 敵を倒すのは踏みつけ（プレイヤーが下向きに当たったとき）のみ
-                    elif player.vy > 0 and player.rect.bottom - e.rect.top < 20:
-                        enemies.remove(e)
-                        player.vy = -8
-                    elif player.power in ('fire', 'ice','speed','jump'):
-                            player.clear_power()
-                    else:
-                        dead = True
-            #落ちてくる敵との衝突判定
-            for fe in falling_enemies:
-                if player.rect.colliderect(fe.rect):
-                    # 無敵（muteki）は触れると敵を倒す
-                    if player.power == 'muteki':
-                        falling_enemies.remove(fe)
-                    # 敵を倒すのは踏みつけ（プレイヤーが下向きに当たったとき）のみ
-                    elif player.vy > 0 and player.rect.bottom  - fe.rect.top < 20:
-                        falling_enemies.remove(fe)
-                        player.vy = -8
-                    elif player.power in ('fire', 'ice'):
-                        player.clear_power()
-                    else:
-                        dead = True
-            # アイテム取得判定
-            for it in items[:]:
-                if player.rect.colliderect(it.rect):
-                    player.apply_power(it.kind, duration=it.duration)
-                    items.remove(it)
-            # ゴールとの当たり判定
-            for g in goal_platforms:
-                if player.rect.colliderect(g.rect):
-                    state = "goal"
-            #　穴に落ちた時の処理
-            if player.rect.top > HEIGHT:
-                dead = True
-            if dead:
-                state = "gameover"
-
-            # ステージ切り替え（ゴールステージでない場合のみ）
-            goal_stage_index = len(STAGE_BUILDERS) -1
-            if player.rect.right > WIDTH and stage_index != goal_stage_index and state != "goal":
-                stage_index_count += 1
-                # 5ステージクリアしたらゴールステージへ
-                if stage_index_count >= stage_num:
-                    stage_index = goal_stage_index
-                else:
-                    # 次のランダムなステージへ（ゴールステージを除く）
-                    stage_index = random.randint(0, goal_stage_index - 1)
-                _, platforms, ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, falling_enemies, items, projectiles = init_game(stage_index)
-                player.rect.left = 0  # プレイヤーを左端に配置
-                player.rect.bottom = ground_y - Player_base_height # Y座標も初期位置に戻す
-        # ゲームオーバー画面
-        elif state == "gameover":
-            # テキストのRectを取得するために、描画前にフォントを準備
-            font = pg.font.Font(None, 100)
-            text_surf = font.render("GAME OVER", True, WHITE)
-            text_rect = text_surf.get_rect(center=(WIDTH // 2, HEIGHT // 3))
-            screen.blit(text_surf, text_rect)
-
-            # テキストの四隅に敵を表示
-            draw_text(screen, "R : Retry", 80, WIDTH // 2, HEIGHT // 2 + 60, BLACK)
-            draw_text(screen, "ESC : Quit", 80, WIDTH // 2, HEIGHT // 2 + 120, BLACK)
-            pg.display.flip()
-
-            if keys[pg.K_r]:
-                # init_game の戻り値に合わせる
-                player, platforms, ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, falling_enemies, items, projectiles = init_game(0)
-                stage_index = 0
-                stage_index_count = 0
-                state = "start"
-            elif keys[pg.K_ESCAPE]:
-                running = False
-            continue
+# draw_dynamic で使うレイヤー（元の描画順）
+LAYER_ITEMS, LAYER_FALLING, LAYER_ENEMIES, LAYER_PROJECTILES, LAYER_PLAYER = range(5)
 
-        # ゴール画面
-        elif state == "goal":
-            font = pg.font.Font(None, 100)
-            text_surf = font.render("GOAL!!", True, GOLD)
-            text_rect = text_surf.get_rect(center=(WIDTH // 2, HEIGHT // 3))
-            screen.blit(text_surf, text_rect)
-            draw_text(screen, f"Clear Time: {play_time:.2f}", 50, WIDTH // 2, HEIGHT // 2, WHITE)
-            draw_text(screen, "R : Retry", 80, WIDTH // 2, HEIGHT // 2 + 60, BLACK)
-            draw_text(screen, "ESC : Quit", 80, WIDTH // 2, HEIGHT // 2 + 120, BLACK)
-            pg.display.flip()
-            if keys[pg.K_r]:
-                # init_game の戻り値に合わせる
-                player, platforms, ground_platforms, floating_platforms, hatena_platforms, goal_platforms, enemies, falling_enemies, items, projectiles = init_game(0)
-                stage_index = 0
-                stage_index_count = 0
-                play_time = 0.0
-                state = "start"
-            elif keys[pg.K_ESCAPE]:
-                running = False
-            continue
 
+class StaticLayer:
+    """
+    背景・地面・浮遊ブロック・ハテナブロック・ゴールと HUD の文字を1枚に合成した Surface のキャッシュ
+    ステージの読み込み時、ハテナブロックの画像が変わったとき、クリアしたステージ数が変わったときだけ作り直す
+    """
+    def __init__(self, size=(WIDTH, HEIGHT)):
+        self.size = size
+        self.surface = None
+        self.key = None
+        self.builds = 0
+        self.chunk_layers = {}  # スクロール時: チャンクの番号 -> (Stage, キー, Surface)
+
+    def get(self, world):
+        key = (world.stage_version, tuple(b.used for b in world.hatena_platforms), world.stage_index_count)
+        if key != self.key:
+            self._build(world)
+            self.key = key
+        return self.surface
+
+    def _build(self, world):
+        if self.surface is None:
+            self.surface = pg.Surface(self.size).convert()
+        self._compose(self.surface, world)
+        draw_hud_text(self.surface, world)
+
+    def _compose(self, surf, stage, offset_x=0):
+        """stage（World か Stage）の背景と足場を surf に描く。offset_x はチャンクの左端"""
+        queue = RenderQueue()
         #背景描画
-        screen.blit(bg_img, (0, 0))
-        # 地面を描画
-        for p in ground_platforms:
-            # 地面はタイル状に描画
-            # 元画像の縦横比を維持し、p.heightを基準にリサイズ
-            orig_w, orig_h = ground_img.get_size()
-            scaled_img = pg.transform.scale(ground_img, (p.width, p.height))
-            screen.blit(scaled_img, p)
+        queue.add(0, ASSETS.get(BG_IMAGE, (WIDTH, HEIGHT), alpha=False), (0, 0))
+        # 地面を描画（rect の大きさに合わせて拡大した画像は ASSETS が保持する）
+        for p in stage.ground_platforms:
+            queue.add(1, ASSETS.get(GROUND_IMAGE, p.size), (p.x - offset_x, p.y))
         # 浮遊ブロックを描画 (ice_block.png)
-        for p in floating_platforms:
-            # 元画像の縦横比を維持し、p.heightを基準にリサイズ
-            orig_w, orig_h = block_img.get_size()
-            scaled_img = pg.transform.scale(block_img, (p.width, p.height))
-            # 当たり判定pを、リサイズ後の画像に合わせて更新
-            p.size = scaled_img.get_size()
-            p.center = p.center # 元の中心位置を維持
-            screen.blit(scaled_img, p)
+        for p in stage.floating_platforms:
+            queue.add(2, ASSETS.get(BLOCK_IMAGE, p.size), (p.x - offset_x, p.y))
         # はてなブロックを描画 (hatena_block.png)
-        for p in hatena_platforms:
-            p.draw(screen)
+        for p in stage.hatena_platforms:
+            queue.add_sprite(3, p, offset_x=offset_x)
         # ゴールを描画 (goal_pole.png)
-        for p in goal_platforms:
-            p.draw(screen)
-
-        # 描画
-        for it in items:
-            it.draw(screen)
-        for fe in falling_enemies:
-            fe.draw(screen)
-        for e in enemies:
-            e.draw(screen)
-        for p in projectiles:
-            p.draw(screen)
-        player.draw(screen)
-
-        # 現在の能力を右上に表示
-        power_display.draw(screen, player.power)
-        # タイムを左上に表示(黒い四角の上に白文字)
-        draw_text(screen, f"Time: {play_time:.2f}", 50, 100, 50, WHITE)
-        draw_text(screen, "< >: Move    SPACE : Jump", 30, 150, 100, BLACK)
-        draw_text(screen,"X : ball launch", 30, 100, 150, BLACK)
-        draw_text(screen, f"Stage Cleared: {stage_index_count}/{stage_num}", 30, WIDTH // 2, 50, BLACK)
-        pg.display.flip()
+        for p in stage.goal_platforms:
+            queue.add_sprite(4, p, offset_x=offset_x)
+        queue.flush(surf, doreturn=False)
+        self.builds += 1
 
+    def draw_chunks(self, screen, world, offset_x):
+        """
+        スクロールするとき：チャンクごとに合成した画像を、カメラの位置に合わせて並べる
+        画面に入ったチャンクだけを合成し、捨てられたチャンクの Surface は使い回す
+        """
+        layers = {}
+        spare = []
+        active = world.active_chunks()
+        numbers = {c.number for c in active}
+        for number, layer in self.chunk_layers.items():
+            if number not in numbers:
+                spare.append(layer[2])
+        for chunk in active:
+            left = chunk.number * WIDTH
+            layer = self.chunk_layers.get(chunk.number)
+            if left >= offset_x + WIDTH or left + WIDTH <= offset_x:
+                if layer is not None:
+                    layers[chunk.number] = layer
+                continue # 画面の外
+            key = tuple(b.used for b in chunk.stage.hatena_platforms)
+            if layer is None or layer[0] is not chunk.stage or layer[1] != key:
+                if layer is not None:
+                    surf = layer[2]
+                elif spare:
+                    surf = spare.pop()
+                else:
+                    surf = pg.Surface(self.size).convert()
+                self._compose(surf, chunk.stage, left)
+                layer = (chunk.stage, key, surf)
+            layers[chunk.number] = layer
+            screen.blit(layer[2], (left - offset_x, 0))
+        self.chunk_layers = layers
+
+
+def draw_play(screen, world, static_layer, power_display, alpha=1.0):
+    """
+    プレイ中の画面を描画する
+    alpha: 前のtickから現在のtickまでの補間率（固定タイムステップの端数）
+    """
+    # 背景と足場はまとめて1回で描く
+    if world.camera is not None:
+        static_layer.draw_chunks(screen, world, world.camera_offset(alpha))
+        draw_hud_text(screen, world) # 画面に固定なのでチャンクの画像には含めない
+    else:
+        screen.blit(static_layer.get(world), (0, 0)) # HUD の文字も含む
+    return draw_dynamic(screen, world, power_display, alpha)
+
+
+def draw_hud_text(surf, world):
+    """操作説明とクリアしたステージ数（ステージを進んだときしか変わらないので静的レイヤーに描く）"""
+    draw_text(surf, "< >: Move    SPACE : Jump", 30, 150, 100, BLACK)
+    draw_text(surf, "X : ball launch", 30, 100, 150, BLACK)
+    if world.endless:
+        cleared = f"Stage Cleared: {world.stage_index_count}"
+    else:
+        cleared = f"Stage Cleared: {world.stage_index_count}/{world.stage_num}"
+    draw_text(surf, cleared, 30, WIDTH // 2, 50, BLACK)
+
+
+_DYNAMIC_QUEUE = RenderQueue()
+
+
+def draw_dynamic(screen, world, power_display, alpha=1.0, queue=_DYNAMIC_QUEUE):
+    """
+    動くスプライトとタイム・能力の表示を描画し、描いた領域の rect のリストを返す
+    スプライトは RenderQueue に集めて、レイヤーごとに1回の blits() で描く
+    """
+    world.sync_hazards()
+    offset = world.camera_offset(alpha)
+    # 画面に入るもの（画像は rect より少し大きいので余裕を持たせる）だけを描画
+    left = offset - CULL_MARGIN
+    right = offset + WIDTH + CULL_MARGIN
+    for layer, group in ((LAYER_ITEMS, world.items), (LAYER_FALLING, world.falling_enemies),
+                         (LAYER_ENEMIES, world.enemies), (LAYER_PROJECTILES, world.projectiles)):
+        for obj in group:
+            if obj.rect.right > left and obj.rect.left < right:
+                queue.add_sprite(layer, obj, alpha, offset)
+    queue.add_sprite(LAYER_PLAYER, world.player, alpha, offset)
+    rects = queue.flush(screen)
+
+    # 現在の能力を右上に表示
+    power_rect = power_display.draw(screen, world.player.power)
+    if power_rect:
+        rects.append(power_rect)
+    # タイムを左上に表示(黒い四角の上に白文字)
+    # 毎フレーム変わるタイムは1文字ずつの画像を並べて描く
+    rects.append(get_atlas(50, WHITE).draw(screen, f"Time: {world.play_time:.2f}", 100, 50))
+    return rects
+
+
+class DirtyRenderer:
+    """
+    変化した領域だけを描き直して pg.display.update(rects) に渡す描画モード
+    前のフレームでスプライトを描いた場所を静的レイヤーで消し、新しい位置に描き直す
+    """
+    MAX_RECTS = 64  # これより多いときは画面全体を送った方が速い
+
+    def __init__(self):
+        self.prev_rects = []
+        self.layer_key = None
+        self.scene = None
+
+    def invalidate(self):
+        """次のフレームで画面全体を描き直す"""
+        self.scene = None
+
+    def draw(self, screen, scene, world, static_layer, power_display, alpha=1.0):
+        """描画して、画面に送るべき rect のリストを返す（何も変わらなければ空）"""
+        full = screen.get_rect()
+        if scene != "play":
+            # メニュー画面は内容が変わったときだけ描く
+            if scene == self.scene:
+                return []
+            self.scene = scene
+            draw_menu(screen, scene, world, power_display)
+            return [full]
+        if world.camera is not None:
+            # スクロールするときは毎フレーム画面全体が変わる
+            self.scene = None
+            draw_play(screen, world, static_layer, power_display, alpha)
+            return [full]
+        layer = static_layer.get(world)
+        if self.scene != "play" or static_layer.key != self.layer_key:
+            self.scene = "play"
+            self.layer_key = static_layer.key
+            self.prev_rects = draw_play(screen, world, static_layer, power_display, alpha)
+            return [full]
+        # 前のフレームのスプライトを背景で消す
+        for r in self.prev_rects:
+            screen.blit(layer, r, r)
+        rects = draw_dynamic(screen, world, power_display, alpha)
+        dirty = self.prev_rects + rects
+        self.prev_rects = rects
+        if len(dirty) > self.MAX_RECTS:
+            return [full]
+        return [r.clip(full) for r in dirty]
+
+
+def draw_loading(screen, progress):
+    """読み込み中の画面（画像を使わずに描けるので、起動してすぐに出せる）"""
+    screen.fill(BG)
+    draw_text(screen, "Loading...", 80, WIDTH // 2, HEIGHT // 2 - 40, WHITE)
+    return draw_progress(screen, progress, HEIGHT // 2 + 30)
+
+
+def draw_progress(screen, progress, y=HEIGHT - 30):
+    """読み込みの進み具合のバー。描いた rect を返す"""
+    bar = pg.Rect(0, 0, WIDTH // 2, 16)
+    bar.center = (WIDTH // 2, y)
+    pg.draw.rect(screen, WHITE, (bar.x, bar.y, int(bar.width * progress), bar.height))
+    pg.draw.rect(screen, BLACK, bar, 2)
+    return bar
+
+
+def draw_menu(screen, scene, world, power_display):
+    """スタート・ゲームオーバー・ゴール画面を描画する"""
+    # スタート画面
+    if scene == "start":
+        screen.blit(ASSETS.get(BG_IMAGE, (WIDTH, HEIGHT), alpha=False), (0, 0))
+        #パワーアップアイテムを適当に表示
+        power_display.draw(screen, world.player.power)
+
+        draw_text(screen, "GAME START", 100, WIDTH // 2, HEIGHT // 3, WHITE)
+        draw_text(screen, "SPACE : Start", 80, WIDTH // 2, HEIGHT // 2)
+        draw_text(screen, "< >: Move    SPACE : Jump", 80, WIDTH // 2, HEIGHT // 2 + 60, BLACK)
+    # ゲームオーバー画面（最後のプレイ画面の上に重ねて表示する）
+    elif scene == "gameover":
+        draw_text(screen, "GAME OVER", 100, WIDTH // 2, HEIGHT // 3, WHITE)
+        draw_text(screen, "C : Continue", 80, WIDTH // 2, HEIGHT // 2, BLACK)
+        draw_text(screen, "R : Retry", 80, WIDTH // 2, HEIGHT // 2 + 60, BLACK)
+        draw_text(screen, "ESC : Quit", 80, WIDTH // 2, HEIGHT // 2 + 120, BLACK)
+    # ゴール画面
+    elif scene == "goal":
+        draw_text(screen, "GOAL!!", 100, WIDTH // 2, HEIGHT // 3, GOLD)
+        draw_text(screen, f"Clear Time: {world.play_time:.2f}", 50, WIDTH // 2, HEIGHT // 2, WHITE)
+        draw_text(screen, "R : Retry", 80, WIDTH // 2, HEIGHT // 2 + 60, BLACK)
+        draw_text(screen, "ESC : Quit", 80, WIDTH // 2, HEIGHT // 2 + 120, BLACK)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="北極探検ゲーム")
+    parser.add_argument("--fps", type=int, default=FPS,
+                        help="描画の最大フレームレート（0で無制限）。ゲームの速さは変わらない")
+    parser.add_argument("--dirty", action="store_true",
+                        help="変化した領域だけを画面に送る（低性能な端末向け）")
+    parser.add_argument("--seed", type=int, default=None, help="乱数の seed（省略時はランダム）")
+    parser.add_argument("--record", metavar="PATH", help="プレイの入力をリプレイファイルに保存する")
+    parser.add_argument("--replay", metavar="PATH", help="リプレイファイルを再生する")
+    parser.add_argument("--scroll", action="store_true",
+                        help="ステージを横に並べた長いステージをスクロールして遊ぶ")
+    parser.add_argument("--endless", action="store_true",
+                        help="自動生成したステージがどこまでも続く（--scroll を含む）")
+    parser.add_argument("--pixel-collisions", action="store_true",
+                        help="敵との当たり判定を画像の形で行う（透明な部分では当たらない）")
+    parser.add_argument("--stage-num", type=int, default=5, help="ゴールまでのステージ数")
+    parser.add_argument("--save-file", metavar="PATH", default=os.path.join(BASE_DIR, "save.dat"),
+                        help="F5 で状態を保存し、F9 で読み込むファイル")
+    parser.add_argument("--load", metavar="PATH", help="セーブファイルの状態から始める")
+    parser.add_argument("--speed", type=float, default=1.0, help="リプレイの再生速度の倍率")
+    parser.add_argument("--headless", action="store_true",
+                        help="--replay を画面なしで最速で実行し、結果を検証する")
+    parser.add_argument("--profile", action="store_true",
+                        help="処理ごとの時間を計る（F3 でオーバーレイを表示）")
+    parser.add_argument("--threaded", action="store_true",
+                        help="ゲームの進行を別のスレッドで行い、描画が遅れても操作と物理の間隔を保つ")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="最初の画面が出るまでと操作できるまでの時間を表示して終了する")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="計測結果を Chrome のトレース形式の JSON に書き出す（--profile を含む）")
+    args = parser.parse_args(argv)
+    if args.load and (args.record or args.replay):
+        parser.error("--load は --record / --replay と一緒には使えません")
+    return args
+
+
+def run_replay_headless(path):
+    """リプレイを画面なしで実行し、最終状態とクリアタイムを検証する"""
+    replay = Replay.load(path)
+    ok, world, tps = replay.run_headless()
+    print(f"{path}: {len(replay.inputs)} ticks, {tps:.0f} ticks/s, "
+          f"clear time {world.play_time:.2f}, {'OK' if ok else 'MISMATCH'}")
+    if not ok:
+        print(f"  expected {replay.summary}")
+        print(f"  actual   {world.summary()}")
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.replay and args.headless:
+        return run_replay_headless(args.replay)
+    pg.init()
+    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    pg.display.set_caption("北極探検ゲーム")
+    # 画像を読み込む前に、まず読み込み画面を出す
+    draw_loading(screen, 0.0)
+    pg.display.flip()
+    startup = {"first frame": time.perf_counter() - PROCESS_START}
+    clock = pg.time.Clock()
+
+    static_layer = StaticLayer()
+    dirty_renderer = DirtyRenderer() if args.dirty else None
+
+    replay = Replay.load(args.replay) if args.replay else None
+    if replay is not None:
+        world = replay.new_world(prefetch=True)
+        replay_inputs = replay.input_states()
+        speed = args.speed
+    elif args.load:
+        world = World.from_state(load_game(args.load), prefetch=True)
+        speed = 1.0
+    else:
+        world = World(seed=args.seed, stage_num=args.stage_num, prefetch=True, scroll=args.scroll,
+                      endless=args.endless, pixel_collisions=args.pixel_collisions)
+        speed = 1.0
+    recorder = InputRecorder(world) if args.record else None
+    profiler = FrameProfiler() if args.profile or args.trace else NULL_PROFILER
+    if not args.threaded:
+        world.profiler = profiler # FrameProfiler は1つのスレッドからしか使えない
+    show_overlay = False
+
+    def quicksave(w):
+        save_game(args.save_file, w)
+        print(f"saved: {args.save_file}")
+
+    def quickload(w):
+        try:
+            w.restore_state(load_game(args.save_file))
+        except (OSError, ValueError) as e:
+            print(f"{args.save_file}: 読み込めませんでした ({e})")
+
+    # ステージ切り替えや弾の発射で読み込みが起きないよう、全画像をバックグラウンドで用意する
+    loader = AssetLoader(masks=world.pixel_collisions).start([world])
+    # スタート画面の画像がそろうまでは読み込み画面を描く
+    while not loader.start_ready:
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                pg.quit()
+                return 0
+        draw_loading(screen, loader.progress)
+        pg.display.flip()
+        clock.tick(FPS)
+    loader.check()
+    power_display = PowerUpDisplay(pos=(WIDTH - 80, 20))
+    sim = None
+    if args.threaded:
+        sim = SimulationThread(world, replay_inputs if replay is not None else None, recorder, speed).start()
+    accumulator = 0.0
+    fire = False
+    loading = True  # 残りの画像をまだ読み込んでいる（スタート画面にバーを出す）
+    idle = False  # メニュー画面を描き終えて、入力を待つだけでよい
+    pending = False  # 入力があってから、まだゲームが1tickも進んでいない
+    drawn_menu = None  # 画面に出ているメニュー画面（同じものは描き直さない）
+    last_tick = None
+    while world.running:
+        if idle:
+            # キーが押されるまで（読み込み中はバーを進める間隔で）眠る
+            event = pg.event.wait(LOADING_WAIT_MS if loading else MENU_WAIT_MS)
+            if event.type != pg.NOEVENT:
+                pg.event.post(event) # 下の pg.event.get() でいつもどおり処理する
+            clock.tick() # 眠っていた時間の分はゲームを進めない
+            # キーが押されたら待たずに1tick進めて、すぐに反応する
+            accumulator = SIM_DT if event.type != pg.NOEVENT else 0.0
+        else:
+            # 固定タイムステップ: 経過時間を貯めて SIM_DT ごとにゲームを進める
+            # 遅いマシンでは描画が間引かれ、速いマシンでは60Hz以上で描画できる
+            frame_time = min(clock.tick(args.fps) / 1000.0, MAX_FRAME_TIME)
+            accumulator += frame_time * speed
+        profiler.end_frame()
+        profiler.begin("input")
+        for event in pg.event.get():
+            pending = True
+            if event.type == pg.QUIT:
+                world.running = False
+            if event.type == pg.KEYDOWN and event.key == pg.K_x: #xが押されたときに球を発射
+                fire = True
+            if event.type == pg.KEYDOWN and event.key == pg.K_F3 and profiler.enabled:
+                show_overlay = not show_overlay
+            # セーブと読み込み（リプレイの再生中と記録中は入力と合わなくなるので行わない）
+            if (event.type == pg.KEYDOWN and event.key in (pg.K_F5, pg.K_F9)
+                    and replay is None and recorder is None):
+                action = quicksave if event.key == pg.K_F5 else quickload
+                if sim is not None:
+                    sim.call(action) # World を進めているスレッドで行う
+                else:
+                    action(world)
+        keys = pg.key.get_pressed()
+        if loading and loader.done:
+            loading = False
+            loader.check()
+            startup["all assets"] = time.perf_counter() - PROCESS_START
+            drawn_menu = None # 進み具合のバーを消す
+            if dirty_renderer is not None:
+                dirty_renderer.invalidate()
+            if args.measure_startup:
+                world.running = False
+        profiler.end()
+
+        if sim is not None:
+            # ゲームは別のスレッドで進んでいるので、入力を渡して最新の写しを描くだけ
+            sim.set_input(input_from_keys(keys, False))
+            if fire:
+                sim.fire()
+                fire = False
+            view, alpha = sim.latest()
+            scene = view.state
+            if not sim.alive:
+                world.running = False
+        else:
+            view = world
+            # 更新前の状態で描画する画面を決める（ゲームオーバー直後はプレイ画面を描く）
+            scene = world.state
+        profiler.begin("sim")
+        while sim is None and accumulator >= SIM_DT and world.running:
+            if replay is not None:
+                inp = next(replay_inputs, None)
+                if inp is None: # リプレイの最後まで再生した
+                    world.running = False
+                    break
+            else:
+                inp = input_from_keys(keys, fire)
+                fire = False # 発射は最初のtickだけに渡す
+            if recorder is not None:
+                recorder.record(inp)
+            world.step(inp)
+            accumulator -= SIM_DT
+        profiler.end()
+        if sim is None:
+            alpha = accumulator / SIM_DT
+        if view.tick != last_tick:
+            pending = False
+        # メニュー画面を描いたら、次のフレームからは入力を待って眠る
+        # 別スレッドで進めているときは、そちらも眠っている（tickが進んでいない）ことを確かめる
+        idle = (scene in MENU_STATES and scene == view.state and not pending and not show_overlay
+                and replay is None and (sim is None or view.tick == last_tick))
+        last_tick = view.tick
+        profiler.begin("draw")
+        if dirty_renderer is not None and not show_overlay:
+            rects = dirty_renderer.draw(screen, scene, view, static_layer, power_display, alpha)
+            if loading:
+                rects.append(draw_progress(screen, loader.progress))
+            profiler.end()
+            profiler.begin("flip")
+            if rects:
+                pg.display.update(rects)
+            profiler.end()
+            startup.setdefault("interactive", time.perf_counter() - PROCESS_START)
+            continue
+        if scene == "play":
+            drawn_menu = None
+            draw_play(screen, view, static_layer, power_display, alpha)
+        elif scene == drawn_menu and not loading and not show_overlay:
+            profiler.end()
+            continue # 描いてあるメニュー画面はそのまま
+        else:
+            drawn_menu = scene
+            draw_menu(screen, scene, view, power_display)
+        if loading:
+            draw_progress(screen, loader.progress)
+        if show_overlay:
+            profiler.draw_overlay(screen)
+            drawn_menu = None
+            if dirty_renderer is not None:
+                dirty_renderer.invalidate()
+        profiler.end()
+        profiler.begin("flip")
+        pg.display.flip()
+        profiler.end()
+        # 最初のスタート画面を出した時点から操作できる
+        startup.setdefault("interactive", time.perf_counter() - PROCESS_START)
+
+    if sim is not None:
+        sim.stop()
+    if args.measure_startup:
+        for name, seconds in startup.items():
+            print(f"{name:12s} {seconds * 1000:8.1f} ms")
+    if recorder is not None:
+        recorder.save(args.record, world)
+    if args.trace:
+        profiler.export_chrome_trace(args.trace)
+    if replay is not None:
+        ok = world.summary() == replay.summary
+        print(f"replay: clear time {world.play_time:.2f}, {'OK' if ok else 'MISMATCH'}")
     pg.quit()
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+北極探検ゲームを自動でプレイさせるための環境（gym 風の reset / step）
+画面を使わずに World を動かし、観測はベクトル、報酬は右へ進んだ距離で返す
+VectorEnv は N 個のゲームをプロセスプールで並列に動かし、観測・報酬は共有メモリでやりとりする
+
+    env = NorthAdventureEnv(seed=0)
+    obs = env.reset()
+    obs, reward, terminated, truncated, info = env.step(env.action_space_n - 1)
+
+    python north_env.py --envs 16 --workers 4 --steps 2000   # 1秒あたりのステップ数を測る
+"""
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import north_adventure as na
+
+# 行動の番号と入力の対応（発射は押した瞬間だけ有効）
+ACTIONS = (
+    na.InputState(),                       # 何もしない
+    na.InputState(left=True),
+    na.InputState(right=True),
+    na.InputState(jump=True),
+    na.InputState(left=True, jump=True),
+    na.InputState(right=True, jump=True),
+    na.InputState(fire=True),
+    na.InputState(right=True, fire=True),
+)
+POWERS = (None, 'fire', 'ice', 'jump', 'speed', 'muteki')
+NEAREST_ENEMIES = 4  # 観測に入れる近くの敵の数
+NEAREST_ITEMS = 2    # 観測に入れる近くのアイテムの数
+GROUND_PROBES = 8    # 足元の先に地面があるかを調べる点の数
+PROBE_STEP = 50      # 調べる点の間隔
+# 観測の長さ: プレイヤー(5) + 能力(6 + 残り時間1) + 敵(4 x 4) + アイテム(2 x 3) + ハテナ(3) + 地面(8)
+OBS_SIZE = 5 + len(POWERS) + 1 + NEAREST_ENEMIES * 4 + NEAREST_ITEMS * 3 + 3 + GROUND_PROBES
+
+GOAL_REWARD = 10.0
+DEATH_PENALTY = -5.0
+TICK_PENALTY = -0.001  # 立ち止まり続けないよう、毎tick少しだけ減らす
+
+
+class NorthAdventureEnv:
+    """
+    1つのゲームを自動プレイ用に包んだもの
+    frame_skip: 1回の step で同じ行動を続ける tick 数
+    max_ticks: これを超えたら打ち切る（truncated）
+    それ以外の引数は World に渡す
+    """
+    action_space_n = len(ACTIONS)
+    observation_size = OBS_SIZE
+
+    def __init__(self, seed=None, frame_skip=4, max_ticks=60 * 120, **world_kwargs):
+        self.seed = seed
+        self.frame_skip = frame_skip
+        self.max_ticks = max_ticks
+        self.world_kwargs = world_kwargs
+        self.world = None
+        self.best_x = 0
+        self.episodes = 0
+
+    def reset(self, seed=None):
+        """新しいゲームを始めて最初の観測を返す。seed を省略すると前の seed から決める"""
+        if seed is None and self.seed is not None:
+            seed = self.seed + self.episodes
+        self.episodes += 1
+        self.world = na.World(seed=seed, **self.world_kwargs)
+        self.world.step(na.InputState(jump=True))  # スタート画面を抜ける
+        self.best_x = self.progress()
+        return self.observe()
+
+    def progress(self):
+        """スタートから右へ進んだ距離（ステージをまたいでも増え続ける）"""
+        world = self.world
+        if world.camera is not None:
+            return world.player.rect.x
+        return world.stage_index_count * na.WIDTH + world.player.rect.x
+
+    def step(self, action):
+        """戻り値: (観測, 報酬, 終わったか, 打ち切ったか, 情報)"""
+        world = self.world
+        inp = ACTIONS[action]
+        reward = 0.0
+        for i in range(self.frame_skip):
+            world.step(inp if i == 0 else inp._replace(fire=False))
+            reward += TICK_PENALTY
+            if world.state != "play":
+                break
+        # 新しく到達した距離だけを報酬にする（行ったり来たりで稼げないように）
+        x = self.progress()
+        if x > self.best_x:
+            reward += (x - self.best_x) / na.WIDTH
+            self.best_x = x
+        terminated = world.state in ("gameover", "goal")
+        if world.state == "goal":
+            reward += GOAL_REWARD
+        elif world.state == "gameover":
+            reward += DEATH_PENALTY
+        truncated = not terminated and world.tick >= self.max_ticks
+        info = {"state": world.state, "stage": world.stage_index_count, "tick": world.tick,
+                "play_time": world.play_time}
+        return self.observe(), reward, terminated, truncated, info
+
+    def observe(self, out=None):
+        """今の状態を長さ OBS_SIZE の float32 のベクトルにする（out に書き込むこともできる）"""
+        world = self.world
+        world.sync_hazards()
+        obs = np.zeros(OBS_SIZE, dtype=np.float32) if out is None else out
+        if out is not None:
+            obs[:] = 0
+        player = world.player
+        px, py = player.rect.center
+        obs[0] = (px - world.camera_offset()) / na.WIDTH
+        obs[1] = py / na.HEIGHT
+        obs[2] = player.vx / 10
+        obs[3] = player.vy / 20
+        obs[4] = player.on_ground
+        obs[5 + POWERS.index(player.power)] = 1
+        i = 5 + len(POWERS)
+        obs[i] = player.power_time / 10
+        i += 1
+        # 近い敵から順に、相対位置と種類（1: 落ちてくる敵）
+        hazards = [(e, 0.0) for e in world.enemies] + [(fe, 1.0) for fe in world.falling_enemies]
+        hazards.sort(key=lambda h: abs(h[0].rect.centerx - px) + abs(h[0].rect.centery - py))
+        for obj, kind in hazards[:NEAREST_ENEMIES]:
+            obs[i:i + 4] = (1, (obj.rect.centerx - px) / na.WIDTH, (obj.rect.centery - py) / na.HEIGHT, kind)
+            i += 4
+        i = 5 + len(POWERS) + 1 + NEAREST_ENEMIES * 4
+        items = sorted(world.items, key=lambda it: abs(it.rect.centerx - px) + abs(it.rect.centery - py))
+        for it in items[:NEAREST_ITEMS]:
+            obs[i:i + 3] = (1, (it.rect.centerx - px) / na.WIDTH, (it.rect.centery - py) / na.HEIGHT)
+            i += 3
+        i = 5 + len(POWERS) + 1 + NEAREST_ENEMIES * 4 + NEAREST_ITEMS * 3
+        blocks = [b for b in world.hatena_platforms if not b.used]
+        if blocks:
+            b = min(blocks, key=lambda b: abs(b.rect.centerx - px))
+            obs[i:i + 3] = (1, (b.rect.centerx - px) / na.WIDTH, (b.rect.centery - py) / na.HEIGHT)
+        i += 3
+        # 進行方向の先の地面（穴を見つけるため）
+        for k in range(GROUND_PROBES):
+            obs[i + k] = world.tiles.solid_at(px + player.facing * (k + 1) * PROBE_STEP, na.ground_y + 1)
+        return obs
+
+
+def _worker(conn, indices, env_kwargs, seeds, shm_names, num_envs):
+    """VectorEnv のプロセス。受け持ちの環境を動かし、結果を共有メモリに書く"""
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    obs, rewards, flags, actions = _shared_arrays(shms, num_envs)
+    envs = {i: NorthAdventureEnv(seed=seeds[i], **env_kwargs) for i in indices}
+    try:
+        while True:
+            cmd = conn.recv()
+            if cmd == "reset":
+                for i, env in envs.items():
+                    env.reset()
+                    env.observe(out=obs[i])
+                    rewards[i] = 0
+                    flags[i] = 0
+            elif cmd == "step":
+                for i, env in envs.items():
+                    _, reward, terminated, truncated, _ = env.step(int(actions[i]))
+                    rewards[i] = reward
+                    flags[i] = terminated | (truncated << 1)
+                    # 終わった環境はその場でやり直し、次の観測を返す
+                    if terminated or truncated:
+                        env.reset()
+                    env.observe(out=obs[i])
+            elif cmd == "close":
+                break
+            conn.send(None)
+    finally:
+        del obs, rewards, flags, actions
+        for shm in shms:
+            shm.close()
+
+
+def _shared_arrays(shms, num_envs):
+    """共有メモリを (観測, 報酬, 終了フラグ, 行動) の numpy 配列として見る"""
+    return (np.ndarray((num_envs, OBS_SIZE), dtype=np.float32, buffer=shms[0].buf),
+            np.ndarray((num_envs,), dtype=np.float32, buffer=shms[1].buf),
+            np.ndarray((num_envs,), dtype=np.uint8, buffer=shms[2].buf),
+            np.ndarray((num_envs,), dtype=np.int32, buffer=shms[3].buf))
+
+
+class VectorEnv:
+    """
+    num_envs 個の NorthAdventureEnv を workers 個のプロセスで並列に動かす
+    行動・観測・報酬・終了フラグは共有メモリの配列に置き、パイプでは合図だけを送る
+    終わった環境は自動でやり直す（step が返す観測はやり直した後のもの）
+    """
+    def __init__(self, num_envs, seed=0, workers=None, **env_kwargs):
+        self.num_envs = num_envs
+        workers = min(num_envs, workers or os.cpu_count() or 1)
+        sizes = (num_envs * OBS_SIZE * 4, num_envs * 4, num_envs, num_envs * 4)
+        self._shms = [shared_memory.SharedMemory(create=True, size=size) for size in sizes]
+        self.obs, self.rewards, self.flags, self.actions = _shared_arrays(self._shms, num_envs)
+        seeds = [seed + i * 1000003 for i in range(num_envs)]
+        ctx = mp.get_context("spawn" if sys.platform == "win32" else "fork")
+        self._conns = []
+        self._procs = []
+        for w in range(workers):
+            parent, child = ctx.Pipe()
+            indices = list(range(w, num_envs, workers))
+            proc = ctx.Process(target=_worker, daemon=True,
+                               args=(child, indices, env_kwargs, seeds, [s.name for s in self._shms], num_envs))
+            proc.start()
+            child.close()
+            self._conns.append(parent)
+            self._procs.append(proc)
+        self.closed = False
+
+    def _broadcast(self, cmd):
+        for conn in self._conns:
+            conn.send(cmd)
+        for conn in self._conns:
+            conn.recv()
+
+    def reset(self):
+        self._broadcast("reset")
+        return self.obs.copy()
+
+    def step(self, actions):
+        """戻り値: (観測, 報酬, 終わったか, 打ち切ったか) をそれぞれ num_envs 個の配列で"""
+        self.actions[:] = actions
+        self._broadcast("step")
+        return (self.obs.copy(), self.rewards.copy(),
+                (self.flags & 1).astype(bool), (self.flags & 2).astype(bool))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self._conns:
+            try:
+                conn.send("close")
+            except (BrokenPipeError, OSError):
+                pass
+        for proc in self._procs:
+            proc.join(timeout=5)
+        del self.obs, self.rewards, self.flags, self.actions
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="自動プレイ用の環境の速さを測る（ランダムな行動）")
+    parser.add_argument("--envs", type=int, default=16, help="同時に動かすゲームの数")
+    parser.add_argument("--workers", type=int, default=None, help="プロセスの数（省略時は CPU の数）")
+    parser.add_argument("--steps", type=int, default=1000, help="step を呼ぶ回数")
+    parser.add_argument("--frame-skip", type=int, default=4, help="1 step あたりの tick 数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    with VectorEnv(args.envs, seed=args.seed, workers=args.workers, frame_skip=args.frame_skip) as env:
+        env.reset()
+        episodes = 0
+        start = time.perf_counter()
+        for _ in range(args.steps):
+            _, _, terminated, truncated = env.step(rng.integers(0, len(ACTIONS), args.envs))
+            episodes += int(terminated.sum() + truncated.sum())
+        elapsed = time.perf_counter() - start
+    steps = args.steps * args.envs
+    print(f"{args.envs} envs, {len(env._procs)} workers: {steps / elapsed:.0f} steps/s "
+          f"({steps * args.frame_skip / elapsed:.0f} ticks/s), {episodes} episodes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""画面があるときの画像の用意のテスト（python -m pytest -q）"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from types import SimpleNamespace
+
+import pygame as pg
+import pytest
+
+import north_adventure as na
+
+
+GOAL_STAGE = len(na.STAGE_BUILDERS) - 1
+
+
+@pytest.fixture
+def display():
+    """画面を開く（画面がないと warm_stage_assets は何もしない）"""
+    pg.display.init()
+    yield pg.display.set_mode((na.WIDTH, na.HEIGHT))
+    pg.display.quit()
+
+
+def test_warm_stage_assets_prepares_goal(display):
+    stage = na.build_stage(GOAL_STAGE, 1)
+    assert stage.goal_platforms
+    na.warm_stage_assets(stage)
+    misses = na.ASSETS.misses
+    for g in stage.goal_platforms:
+        na.ASSETS.get(na.GOAL_IMAGE, g.rect.size)
+    assert na.ASSETS.misses == misses
+
+
+def test_prefetcher_builds_goal_stage(display):
+    prefetcher = na.StagePrefetcher()
+    prefetcher.request(GOAL_STAGE, 1)
+    assert prefetcher.take(GOAL_STAGE, 1) is not None
+    assert prefetcher.hits == 1
+
+
+def test_asset_loader_survives_broken_stage(display, capsys):
+    broken = SimpleNamespace(ground_platforms=[None], floating_platforms=[], goal_platforms=[])
+    goal = na.build_stage(GOAL_STAGE, 1)
+    loader = na.AssetLoader().start([broken, goal])
+    loader._thread.join()
+    loader.check() # ステージの失敗はメインのスレッドに投げ直さない
+    assert loader.done
+    assert "ステージの画像を用意できませんでした" in capsys.readouterr().err
+
+
+def test_masks_do_not_reread_files(monkeypatch):
+    assets = na.AssetCache()
+    loads = []
+    load = pg.image.load
+    monkeypatch.setattr(pg.image, "load", lambda path: loads.append(path) or load(path))
+    keys = na.mask_asset_keys(assets)
+    for key in keys:
+        assets.mask(*key)
+    assert len(loads) == len({path for path, _, _ in keys})
+
+
+def test_pixel_collisions_use_prebuilt_masks(display, monkeypatch):
+    na.warm_sprite_assets(masks=True)
+    # 作っておいたマスクだけで足り、プレイ中はファイルを読まない
+    monkeypatch.setattr(pg.image, "load", lambda path: pytest.fail(f"loaded {path} during play"))
+    world = na.World(seed=1, pixel_collisions=True)
+    world.step(na.InputState(jump=True))
+    for tick in range(2000):
+        world.step(na.InputState(right=tick % 90 < 70, jump=tick % 25 == 0, fire=tick % 10 == 0))
+        if world.state != "play":
+            world.reset()
+            world.step(na.InputState(jump=True))
+
+
+def test_hud_text_is_drawn_into_static_layer(display):
+    pg.font.init()
+    world = na.World(seed=1)
+    world.step(na.InputState(jump=True))
+    layer = na.StaticLayer()
+    renderer = na.DirtyRenderer()
+    renderer.draw(display, world.state, world, layer, na.PowerUpDisplay((820, 20)), 0.5)
+    builds = layer.builds
+    world.step(na.InputState(right=True))
+    rects = renderer.draw(display, world.state, world, layer, na.PowerUpDisplay((820, 20)), 0.5)
+    # 操作説明は毎フレーム描き直さない
+    help_rect = pg.Rect(0, 80, 300, 90)
+    assert not any(r.colliderect(help_rect) for r in rects if r.w < na.WIDTH)
+    world.stage_index_count += 1
+    layer.get(world)
+    assert layer.builds == builds + 1
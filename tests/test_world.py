@@ -0,0 +1,134 @@
+"""World の決定性のテスト（python -m pytest -q）"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import heapq
+import json
+import random
+
+import pytest
+
+import north_adventure as na
+
+
+MODES = {
+    "stages": {},
+    "scroll": {"scroll": True},
+    "endless": {"endless": True},
+    "pixel": {"pixel_collisions": True},
+}
+
+
+def random_inputs(seed, ticks):
+    """ほぼ右に進みながら、ジャンプ・攻撃・やり直しを混ぜた入力"""
+    r = random.Random(seed)
+    return [na.InputState(right=r.random() < 0.8, left=r.random() < 0.1, jump=r.random() < 0.3,
+                          fire=r.random() < 0.1, retry=r.random() < 0.02, checkpoint=r.random() < 0.02)
+            for _ in range(ticks)]
+
+
+def fingerprint(world):
+    """比べるための状態（敵やアイテムの位置を含む）"""
+    world.sync_hazards()
+    return (world.summary(), world.player.power, len(world.timers),
+            [e.rect.topleft for e in world.enemies],
+            [fe.rect.topleft for fe in world.falling_enemies],
+            [it.state() for it in world.items],
+            [p.state() for p in world.projectiles])
+
+
+@pytest.mark.skipif(na.np is None, reason="numpy がない")
+@pytest.mark.parametrize("mode", MODES.values(), ids=MODES.keys())
+def test_vectorized_matches_scalar(mode):
+    scalar = na.World(seed=1, **mode)
+    vectorized = na.World(seed=1, vectorized=True, **mode)
+    for tick, inp in enumerate(random_inputs(1, 3000)):
+        scalar.step(inp)
+        vectorized.step(inp)
+        assert fingerprint(vectorized) == fingerprint(scalar), f"tick {tick}"
+
+
+@pytest.mark.parametrize("mode", MODES.values(), ids=MODES.keys())
+def test_save_restore_resimulates_identically(mode):
+    inputs = random_inputs(2, 2400)
+    world = na.World(seed=2, **mode)
+    trace = []
+    saves = {}
+    for tick, inp in enumerate(inputs):
+        if tick % 400 == 200:
+            saves[tick] = world.save_state()
+        world.step(inp)
+        trace.append(fingerprint(world))
+    for start, state in saves.items():
+        # 先に進めた World をその場で戻したものと、ファイルの中身から作り直したもの
+        in_place = na.World(seed=2, **mode)
+        for inp in inputs[:start + 400]:
+            in_place.step(inp)
+        in_place.restore_state(state)
+        from_file = na.World.from_state(na.load_state(na.dump_state(state)))
+        for tick in range(start, len(inputs)):
+            in_place.step(inputs[tick])
+            from_file.step(inputs[tick])
+            assert fingerprint(in_place) == trace[tick], f"saved at {start}, tick {tick}"
+            assert fingerprint(from_file) == trace[tick], f"saved at {start}, tick {tick}"
+
+
+def test_save_blob_is_small():
+    world = na.World(seed=3, scroll=True)
+    for inp in random_inputs(3, 1500):
+        world.step(inp)
+    # 乱数は seed と使った数だけを持つので、チェックポイント込みでも 1KB に収まる
+    assert len(na.dump_state(world.save_state())) < 1024
+
+
+@pytest.mark.parametrize("start", [0, (1 << 16) - 3000, (1 << 24) - 3000, (1 << 32) - 3000],
+                         ids=["zero", "level2", "level3", "overflow"])
+def test_timer_wheel_matches_heap(start):
+    """登録・取り消し・保存と復元を混ぜて、heapq で作った素直な実装と発火を比べる"""
+    r = random.Random(start)
+    wheel = na.TimerWheel()
+    wheel.restore((start, 0, ())) # 段の境目の手前から始める
+    heap = []
+    pending = {}  # seq -> deadline
+    for _ in range(8000):
+        for _ in range(r.randrange(4)):
+            ticks = r.choice([r.randrange(1, 20), r.randrange(1, 600), r.randrange(1, 6000),
+                              r.randrange(1 << 16, 1 << 26), r.randrange(1 << 32, 1 << 33)])
+            seq = wheel.schedule(ticks, "event", wheel.next_seq) # 引数に自分の id を持たせる
+            heapq.heappush(heap, (wheel.now + ticks, seq))
+            pending[seq] = wheel.now + ticks
+        if pending and r.random() < 0.3:
+            seq = r.choice(list(pending))
+            wheel.cancel(seq)
+            del pending[seq]
+        if r.random() < 0.01:
+            # JSON を通して別の TimerWheel か、使っていた TimerWheel 自身に戻す（セーブデータと同じ）
+            restored = na.TimerWheel() if r.random() < 0.5 else wheel
+            restored.restore(json.loads(json.dumps(wheel.state())))
+            wheel = restored
+        fired = wheel.advance()
+        expected = []
+        while heap and heap[0][0] <= wheel.now:
+            deadline, seq = heapq.heappop(heap)
+            if pending.pop(seq, None) is not None:
+                expected.append(seq)
+        assert [args[0] for _, args in fired] == expected, f"now {wheel.now}"
+        assert len(wheel) == len(pending)
+        seq = next(iter(pending), None)
+        if seq is not None:
+            assert wheel.remaining(seq) == pending[seq] - wheel.now
+
+
+def test_falling_enemy_respawns_as_same_instance():
+    world = na.World(seed=3, scroll=True)
+    world.step(na.InputState(jump=True))
+    world.player.apply_power("muteki", duration=100)
+    seen = {id(fe) for fe in world.falling_enemies}
+    respawns = 0
+    for _ in range(1500):
+        before = len(world.fallen)
+        world.step(na.InputState())
+        respawns += before > len(world.fallen)
+        # 出し直した敵は新しく作らず、消えたときのインスタンスを使い回す
+        assert {id(fe) for fe in world.falling_enemies} <= seen
+    assert respawns